@@ -3,6 +3,7 @@ import os
 import sys
 from dotenv import load_dotenv
 import time
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 from botocore.client import Config
 
@@ -11,12 +12,12 @@ from flask_cors import CORS
 from flask_login import LoginManager
 from flask_marshmallow import Marshmallow
 from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import MetaData
 from elasticsearch import Elasticsearch
 import elasticsearch.exceptions
 
 from main_app.exceptions import setup_handlers
+from main_app.routing import RoutingSQLAlchemy
 
 
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
@@ -32,7 +33,8 @@ convention = {
 }
 
 metadata = MetaData(naming_convention=convention)
-db = SQLAlchemy(metadata=metadata)
+# GET requests read from the replica if there is one
+db = RoutingSQLAlchemy(metadata=metadata)
 
 migrate = Migrate()
 ma = Marshmallow()
@@ -65,6 +67,53 @@ def init_elastic(app: Flask):
                 app.elasticsearch.indices.create(index=model.__tablename__)
 
 
+def init_outbound(app: Flask):
+    from main_app.outbound import OutboundClient
+    app.outbound = OutboundClient(app.config)
+
+
+def init_geocoding(app: Flask):
+    from main_app.cache import GeocodingCache
+    # Threads are started on first use, so the pool is not shared between forked workers
+    app.geocoding_executor = ThreadPoolExecutor(
+        max_workers=app.config['GEOCODING_BATCH_WORKERS'], thread_name_prefix='geocoding')
+    app.reverse_geocoding_cache = GeocodingCache(
+        'reverse',
+        maxsize=app.config['GEOCODING_CACHE_SIZE'],
+        ttl=app.config['GEOCODING_CACHE_TTL'],
+        lease_timeout=app.config['GEOCODING_LEASE_TIMEOUT'],
+    )
+    app.forward_geocoding_cache = GeocodingCache(
+        'forward',
+        maxsize=app.config['FORWARD_GEOCODING_CACHE_SIZE'],
+        ttl=app.config['FORWARD_GEOCODING_CACHE_TTL'],
+        lease_timeout=app.config['GEOCODING_LEASE_TIMEOUT'],
+    )
+
+
+def init_ride_index(app: Flask):
+    from sqlalchemy.exc import SQLAlchemyError
+    from main_app.ride_index import RideGridIndex
+    app.ride_index = RideGridIndex(
+        cell_size=app.config['RIDE_INDEX_CELL_SIZE'], ttl=app.config['RIDE_INDEX_TTL'])
+    if not app.config['RIDE_INDEX_ENABLED']:
+        return
+    with app.app_context():
+        try:
+            app.ride_index.warm()
+        except SQLAlchemyError as e:
+            # Groups are loaded lazily on first match anyway
+            app.logger.warning(f'Could not warm the ride index: {e}')
+        finally:
+            db.session.remove()
+
+
+def init_query_stats(app: Flask):
+    from main_app.query_stats import setup_query_stats
+    binds = app.config['SQLALCHEMY_BINDS'] or {}
+    setup_query_stats(app, db.get_engine(app), *(db.get_engine(app, bind=key) for key in binds))
+
+
 def create_app():
     # Configure Sentry if possible
     if 'SENTRY_DSN' in os.environ:
@@ -95,6 +144,10 @@ def create_app():
     from main_app.views import auth, user_and_driver, organization, ride, car, misc, dev_utils     # noqa
     from main_app.views import api
     init_elastic(app)
+    init_outbound(app)
+    init_geocoding(app)
+    init_ride_index(app)
+    init_query_stats(app)
     app.register_blueprint(api)
 
     from main_app.model import User
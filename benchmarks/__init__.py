@@ -0,0 +1,38 @@
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from sqlalchemy import event
+
+
+def percentiles(samples):
+    """
+    :return: p50, p95 and p99 of `samples`, in milliseconds if they are in seconds
+    """
+    return {
+        f'p{q}': float(np.percentile(samples, q)) * 1000 for q in (50, 95, 99)
+    }
+
+
+class QueryCounter:
+    """
+    Counts statements executed by an engine while `counting()` is active in this thread
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self._local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+
+    def _before_cursor_execute(self, *args):
+        if getattr(self._local, 'active', False):
+            self.count += 1
+
+    @contextmanager
+    def counting(self):
+        self._local.active = True
+        try:
+            yield self
+        finally:
+            self._local.active = False
@@ -0,0 +1,104 @@
+"""
+Bulk generator of synthetic organizations and rides for benchmarks.
+
+The factories from `main_app.fixtures` geocode every row and flush one object at a time,
+which is too slow for millions of rides, so rows are inserted with `executemany` here.
+Session events (Elasticsearch, ride index) are bypassed on purpose.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from app import db
+from main_app.model import Car, JoinRideRequest, Organization, Ride, User, \
+    association_user_organization
+
+BENCHMARK_PASSWORD = '12345'
+CHUNK_SIZE = 10000
+
+
+def _insert(table, rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(table.insert(), rows[start:start + CHUNK_SIZE])
+
+
+def generate(rides, organizations=100, active_share=.9, requests_share=.01, seed=0):
+    """
+    Recreate all tables and fill them with `rides` rides spread over `organizations`
+    organizations around Moscow. Every organization has a host with a car,
+    the first user (`benchmark@example.com`) is a member of all of them
+    and has sent undecided or declined join requests to `requests_share` of the rides.
+
+    :return: ids of the organizations
+    """
+    random = np.random.default_rng(seed)
+    db.drop_all()
+    db.create_all()
+
+    member = User(first_name='Bench', last_name='Mark', email='benchmark@example.com',
+                  password=BENCHMARK_PASSWORD)
+    db.session.add(member)
+    db.session.flush()
+    password_hash = member.password
+
+    _insert(User.__table__, [
+        dict(first_name='Host', last_name=str(i), email=f'host_{i}@example.com',
+             _password_hash=password_hash)
+        for i in range(organizations)
+    ])
+    host_ids = [x for x, in db.session.query(User.id).filter(User.id != member.id).
+                order_by(User.id)]
+    _insert(Car.__table__, [
+        dict(model='Lada', color='white', registry_number=f'A{i:03d}AA', owner_id=host_id)
+        for i, host_id in enumerate(host_ids)
+    ])
+    car_ids = [x for x, in db.session.query(Car.id).order_by(Car.owner_id)]
+
+    org_latitudes = random.uniform(55.5, 56., organizations)
+    org_longitudes = random.uniform(37.3, 37.9, organizations)
+    _insert(Organization.__table__, [
+        dict(name=f'Organization {i}', latitude=float(org_latitudes[i]),
+             longitude=float(org_longitudes[i]), address=f'Address {i}', creator_id=host_id)
+        for i, host_id in enumerate(host_ids)
+    ])
+    org_ids = [x for x, in db.session.query(Organization.id).order_by(Organization.id)]
+    _insert(association_user_organization, [
+        dict(left_id=user_id, right_id=org_id)
+        for org_id, host_id in zip(org_ids, host_ids)
+        for user_id in (member.id, host_id)
+    ])
+
+    now = datetime.now()
+    for start in range(0, rides, CHUNK_SIZE):
+        size = min(CHUNK_SIZE, rides - start)
+        orgs = random.integers(0, organizations, size)
+        latitudes = org_latitudes[orgs] + random.uniform(-.3, .3, size)
+        longitudes = org_longitudes[orgs] + random.uniform(-.5, .5, size)
+        start_offsets = random.uniform(-3 * 24 * 60, 3 * 24 * 60, size)
+        prices = random.integers(0, 1000, size)
+        seats = random.integers(1, 7, size)
+        active = random.random(size) < active_share
+        from_organization = random.random(size) < .5
+        db.session.execute(Ride.__table__.insert(), [
+            dict(
+                organization_id=org_ids[orgs[i]], host_id=host_ids[orgs[i]],
+                car_id=car_ids[orgs[i]],
+                latitude=float(latitudes[i]), longitude=float(longitudes[i]),
+                address=f'Address of ride {start + i}',
+                submit_datetime=now,
+                start_datetime=now + timedelta(minutes=float(start_offsets[i])),
+                total_seats=int(seats[i]), price=float(prices[i]),
+                is_active=bool(active[i]), from_organization=bool(from_organization[i]),
+            )
+            for i in range(size)
+        ])
+    first_ride_id = db.session.query(db.func.min(Ride.id)).scalar() or 1
+    requested = random.choice(
+        np.arange(first_ride_id, first_ride_id + rides), size=int(rides * requests_share),
+        replace=False)
+    _insert(JoinRideRequest.__table__, [
+        dict(user_id=member.id, ride_id=int(ride_id), status=int(status))
+        for ride_id, status in zip(requested, random.choice([0, -1], size=len(requested)))
+    ])
+    db.session.commit()
+    return org_ids
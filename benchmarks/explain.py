@@ -0,0 +1,141 @@
+"""
+Query plans of the main endpoints with and without the indexes declared on the models.
+
+Every endpoint is called through the test client, the SELECT statements it runs are
+captured and explained twice: as is, and after dropping all declared indexes inside
+a transaction that is rolled back afterwards. Postgres plans come from
+`EXPLAIN (ANALYZE, BUFFERS)`, SQLite ones from `EXPLAIN QUERY PLAN`.
+
+    python -m benchmarks.explain [--generate 100000]
+
+Uses the database from `DATABASE_URL`. `--generate` DROPS ALL ITS TABLES and fills it with
+`benchmarks.data.generate`, without it the data of the previous run is used.
+"""
+import argparse
+import time
+
+from sqlalchemy import event
+
+from app import create_app, db
+from benchmarks.data import BENCHMARK_PASSWORD, generate
+from main_app.model import Organization, User
+
+MEMBER_EMAIL = 'benchmark@example.com'
+
+
+def endpoints(org_id, latitude, longitude):
+    """
+    :return: (login of the user to call it as, method, url, query args)
+    """
+    host = db.session.query(User).filter(User.id == Organization.creator_id).\
+        filter(Organization.id == org_id).first()
+    return [
+        (MEMBER_EMAIL, 'GET', '/ride/match', {
+            'organizationId': org_id, 'latitude': latitude, 'longitude': longitude,
+            'fromOrganization': True,
+        }),
+        (MEMBER_EMAIL, 'GET', '/ride/active', {}),
+        (MEMBER_EMAIL, 'GET', '/ride/history', {}),
+        (MEMBER_EMAIL, 'GET', '/user/organizations', {}),
+        (MEMBER_EMAIL, 'GET', '/organization', {'id': org_id}),
+        (MEMBER_EMAIL, 'GET', '/organization/members', {'id': org_id}),
+        (host.email, 'GET', '/ride/hosted', {}),
+        (host.email, 'GET', '/ride/requests', {}),
+        (host.email, 'GET', '/car', {}),
+        (host.email, 'POST', '/login', None),
+    ]
+
+
+def capture(app, login, method, url, args):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    client = app.test_client()
+    client.post('/login', json=dict(login=login, password=BENCHMARK_PASSWORD))
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        if method == 'POST':
+            response = client.post(url, json=dict(login=login, password=BENCHMARK_PASSWORD))
+        else:
+            response = client.get(url, query_string=args)
+    finally:
+        with app.app_context():
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    if response.status_code != 200:
+        print(f'  {method} {url} returned {response.status_code}')
+    return statements
+
+
+def explain(cursor, dialect, statement, parameters):
+    prefix = 'EXPLAIN (ANALYZE, BUFFERS) ' if dialect == 'postgresql' else 'EXPLAIN QUERY PLAN '
+    started = time.perf_counter()
+    cursor.execute(prefix + statement, parameters)
+    plan = cursor.fetchall()
+    elapsed = time.perf_counter() - started
+    if dialect == 'postgresql':
+        lines = [row[0] for row in plan]
+    else:
+        # (id, parent, notused, detail)
+        lines = [row[-1] for row in plan]
+    return lines, elapsed
+
+
+def print_plan(title, lines, elapsed):
+    print(f'    {title} ({elapsed * 1000:.2f} ms)')
+    for line in lines:
+        print(f'      {line}')
+
+
+def run(app):
+    with app.app_context():
+        org = db.session.query(Organization).order_by(Organization.id).first()
+        calls = endpoints(org.id, org.latitude, org.longitude)
+        indexes = [
+            index.name for table in db.metadata.sorted_tables for index in table.indexes
+        ]
+        dialect = db.engine.dialect.name
+    captured = [(call, capture(app, *call)) for call in calls]
+
+    with app.app_context():
+        # Two connections: sqlite keeps reusing the cached plan of a statement on the one that
+        # dropped the indexes
+        with_indexes, without_indexes = db.engine.raw_connection(), db.engine.raw_connection()
+        try:
+            plans = {}
+            cursor = with_indexes.cursor()
+            for _, statements in captured:
+                for statement, parameters in statements:
+                    plans[statement] = explain(cursor, dialect, statement, parameters)
+            cursor = without_indexes.cursor()
+            if dialect == 'sqlite':
+                # DDL does not open a transaction by itself in sqlite3
+                cursor.execute('BEGIN')
+            for index in indexes:
+                cursor.execute(f'DROP INDEX IF EXISTS {index}')
+            for (_, method, url, _), statements in captured:
+                print(f'{method} {url}: {len(statements)} SELECT statements')
+                for statement, parameters in statements:
+                    print(f'  {" ".join(statement.split())[:200]}')
+                    print_plan('with indexes', *plans[statement])
+                    print_plan('without', *explain(cursor, dialect, statement, parameters))
+            without_indexes.rollback()
+        finally:
+            with_indexes.close()
+            without_indexes.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--generate', type=int, metavar='RIDES',
+                        help='recreate the tables with this many synthetic rides first')
+    parser.add_argument('--organizations', type=int, default=100)
+    args = parser.parse_args()
+    app = create_app()
+    if args.generate:
+        with app.app_context():
+            generate(args.generate, organizations=args.organizations)
+    run(app)
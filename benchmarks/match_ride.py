@@ -0,0 +1,123 @@
+"""
+End-to-end benchmark of `/ride/match` on synthetic data.
+
+Uses the database from `DATABASE_URL`, e.g. a local Postgres or `sqlite:////tmp/bench.db`.
+ALL ITS TABLES ARE DROPPED, never point it at a database you care about.
+
+    python -m benchmarks.match_ride [--sizes 10000 100000 1000000] [--requests 200]
+
+For every size it reports p50/p95/p99 latency of the whole request, of the SQL prefilter
+and of the ranking step alone, SQL statements per request and peak Python memory.
+"""
+import argparse
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+from flask import url_for
+
+from app import create_app, db
+from benchmarks import QueryCounter, percentiles
+from benchmarks.data import BENCHMARK_PASSWORD, generate
+from main_app.matching import MatchingEngine
+from main_app.model import Organization
+from main_app.schemas import RideSearchSchema
+from main_app.views.auth import login
+from main_app.views.ride import _index_candidates, _query_candidates, match_ride
+from settings import BLUEPRINT_API_NAME
+
+
+def _queries(org_ids, count, seed):
+    random = np.random.default_rng(seed)
+    organizations = {
+        org.id: org for org in db.session.query(Organization).filter(Organization.id.in_(org_ids))
+    }
+    for _ in range(count):
+        org = organizations[org_ids[random.integers(len(org_ids))]]
+        yield {
+            'organizationId': org.id,
+            # Passengers are picked up somewhere around their organization
+            'latitude': org.latitude + random.uniform(-.2, .2),
+            'longitude': org.longitude + random.uniform(-.3, .3),
+            'fromOrganization': bool(random.random() < .5),
+        }
+
+
+def _report(name, samples):
+    values = ' '.join(f'{key}={value:8.2f}ms' for key, value in percentiles(samples).items())
+    print(f'  {name:<12} {values}')
+
+
+def run_size(app, counter, size, organizations, requests, seed):
+    with app.app_context():
+        started = time.perf_counter()
+        org_ids = generate(size, organizations=organizations, seed=seed)
+        print(f'{size} rides in {organizations} organizations, '
+              f'generated in {time.perf_counter() - started:.1f}s')
+        queries = list(_queries(org_ids, requests, seed))
+        app.ride_index.clear()
+
+    with app.test_request_context():
+        url = url_for(f'{BLUEPRINT_API_NAME}.{match_ride.__name__}')
+        login_url = url_for(f'{BLUEPRINT_API_NAME}.{login.__name__}')
+    client = app.test_client()
+    client.post(login_url, json=dict(login='benchmark@example.com', password=BENCHMARK_PASSWORD))
+
+    # Warm-up, loads the ride index groups if it is enabled
+    for query in queries[:min(len(queries), organizations * 2)]:
+        client.get(url, query_string=query)
+
+    latencies, statements = [], []
+    for query in queries:
+        counter.count = 0
+        with counter.counting():
+            started = time.perf_counter()
+            response = client.get(url, query_string=query)
+            latencies.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.data
+        statements.append(counter.count)
+
+    prefilter, ranking = [], []
+    with app.test_request_context():
+        engine = MatchingEngine.from_config(app.config)
+        find_candidates = _index_candidates if app.config['RIDE_INDEX_ENABLED'] \
+            else _query_candidates
+        for query in queries:
+            data = RideSearchSchema().load(query)
+            org = db.session.query(Organization).get(data['id'])
+            started = time.perf_counter()
+            candidates = find_candidates(org, data)
+            prefilter.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            engine.top_k(candidates, data['latitude'], data['longitude'], datetime.now(),
+                         k=data['limit'] + 1)
+            ranking.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    for query in queries[:max(len(queries) // 10, 1)]:
+        client.get(url, query_string=query)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    _report('end-to-end', latencies)
+    _report('prefilter', prefilter)
+    _report('ranking', ranking)
+    print(f'  queries/request: mean={np.mean(statements):.1f} max={max(statements)}')
+    print(f'  peak memory: {peak / 2 ** 20:.1f} MiB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--organizations', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--ride-index', action='store_true', help='match with the ride index')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    app = create_app()
+    app.config['RIDE_INDEX_ENABLED'] = args.ride_index
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+    for size in args.sizes:
+        run_size(app, counter, size, args.organizations, args.requests, args.seed)
@@ -0,0 +1,52 @@
+"""
+Throughput of `MatchingEngine.top_k` on synthetic candidates, no DB or app needed.
+
+    python -m benchmarks.matching_engine [--sizes 1000 10000 100000] [--repeat 50]
+"""
+import argparse
+import time
+from datetime import datetime
+
+import numpy as np
+
+from main_app.matching import Candidates, MatchingEngine
+
+# Around Moscow
+CENTER_LATITUDE, CENTER_LONGITUDE = 55.75, 37.62
+
+
+def generate_candidates(size, seed=0):
+    random = np.random.default_rng(seed)
+    now = datetime.now().timestamp()
+    return Candidates(
+        ids=np.arange(1, size + 1, dtype=np.int64),
+        latitudes=CENTER_LATITUDE + random.uniform(-.3, .3, size),
+        longitudes=CENTER_LONGITUDE + random.uniform(-.5, .5, size),
+        start_timestamps=now + random.uniform(-12, 12, size) * 60 * 60,
+        prices=random.integers(0, 1000, size).astype(np.float64),
+        free_seats=random.integers(0, 5, size).astype(np.float64),
+    )
+
+
+def run(sizes, repeat, k):
+    engine = MatchingEngine(distance_weight=1., time_weight=.05, price_weight=.01, seats_weight=1.)
+    start_datetime = datetime.now()
+    print(f'{"candidates":>10} {"ms/call":>10} {"candidates/s":>14}')
+    for size in sizes:
+        candidates = generate_candidates(size)
+        # Warm-up
+        engine.top_k(candidates, CENTER_LATITUDE, CENTER_LONGITUDE, start_datetime, k)
+        started = time.perf_counter()
+        for _ in range(repeat):
+            engine.top_k(candidates, CENTER_LATITUDE, CENTER_LONGITUDE, start_datetime, k)
+        elapsed = (time.perf_counter() - started) / repeat
+        print(f'{size:>10} {elapsed * 1000:>10.3f} {size / elapsed:>14,.0f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('-k', type=int, default=31)
+    args = parser.parse_args()
+    run(args.sizes, args.repeat, args.k)
@@ -23,7 +23,10 @@ def clean_firebase():
         delete_user(user.uid)
 
 
-def fill_database(app):
+def fill_database(app, scale=1):
+    """
+    :param scale: how many times every ride scenario is repeated in the organization
+    """
     with app.app_context():
         db.drop_all()
         db.create_all()
@@ -45,7 +48,7 @@ def fill_database(app):
             #    - [x] Юзер в организации с тачкой, хостил, нет реквестов
             user_org_host_norequests = UserFactory()
             org.users.append(user_org_host_norequests)
-            for from_organization in [True, False]:
+            for from_organization in [True, False] * scale:
                 ride = RideFactory(
                     organization=org,
                     host=user_org_host_norequests,
@@ -0,0 +1,374 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from app import db
+from main_app.model import GeocodingCacheEntry
+
+
+class LRUCache:
+    """
+    Thread-safe in-process cache with LRU eviction and per-entry TTL.
+    `get` returns `None` for both missing and expired keys.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, allow_expired=False):
+        """
+        Expired entries are kept until evicted, so they can still serve as a fallback
+        with `allow_expired=True`
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic() and not allow_expired:
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one:
+    the first caller runs `func`, the others wait for its result or exception
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """
+        :return: pair `(result, shared)`, `shared` is True for callers that did not run `func`
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, False
+
+
+class GeocodingCache:
+    """
+    Two-tier cache for geocoder answers.
+
+    The first tier lives in the worker process, the second one is `geocoding_cache` table,
+    so answers survive restarts and are shared by all gunicorn workers.
+    The table is accessed with its own connection, the request session is never committed here.
+
+    `fetch` coalesces concurrent misses: threads of one worker wait on a single in-flight call,
+    and workers take a lease on the table row, so only the lease holder asks the geocoder
+    while the others poll the row for its answer.
+    """
+
+    def __init__(self, namespace, maxsize, ttl, persistent=True,
+                 lease_timeout=5., lease_poll_interval=.05):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.persistent = persistent
+        self.lease_timeout = lease_timeout
+        self.lease_poll_interval = lease_poll_interval
+        self.local = LRUCache(maxsize, ttl)
+        self._flight = SingleFlight()
+        self._counters = {'local_hits': 0, 'persistent_hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+
+    def count(self, counter):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + 1
+
+    def _persistent_key(self, key):
+        return f'{self.namespace}:{key}'
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self.count('local_hits')
+            return value
+        if self.persistent:
+            try:
+                value = self._load(key)
+            except SQLAlchemyError as e:
+                # The persistent tier is an optimization, never fail the request because of it
+                current_app.logger.warning(f'Geocoding cache read failed: {e}')
+            if value is not None:
+                self.count('persistent_hits')
+                self.local.set(key, value)
+                return value
+        self.count('misses')
+        return None
+
+    def get_many(self, keys):
+        """
+        `get` of many keys, the persistent tier is read with a single query
+
+        :return: `{key: value}` of the keys that are cached
+        """
+        found, missing = {}, []
+        for key in dict.fromkeys(keys):
+            value = self.local.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                self.count('local_hits')
+                found[key] = value
+        if missing and self.persistent:
+            try:
+                loaded = self._load_many(missing)
+            except SQLAlchemyError as e:
+                current_app.logger.warning(f'Geocoding cache read failed: {e}')
+                loaded = {}
+            for key, value in loaded.items():
+                self.count('persistent_hits')
+                self.local.set(key, value)
+            found.update(loaded)
+        for key in missing:
+            if key not in found:
+                self.count('misses')
+        return found
+
+    def get_stale(self, key):
+        """
+        Last known value regardless of TTL, a fallback for when the geocoder is unavailable
+        """
+        value = self.local.get(key, allow_expired=True)
+        if value is not None or not self.persistent:
+            return value
+        table = GeocodingCacheEntry.__table__
+        try:
+            with db.engine.connect() as connection:
+                row = connection.execute(
+                    db.select([table.c.value]).
+                    where(table.c.key == self._persistent_key(key)).
+                    where(table.c.value.isnot(None))
+                ).first()
+        except SQLAlchemyError as e:
+            current_app.logger.warning(f'Geocoding cache read failed: {e}')
+            return None
+        return json.loads(row.value) if row is not None else None
+
+    def set(self, key, value, ttl=None):
+        """
+        Entries with a custom `ttl` are kept in-process only,
+        the table has a single TTL per namespace
+        """
+        self.local.set(key, value, ttl)
+        if self.persistent and ttl is None:
+            try:
+                self._store(key, value)
+            except SQLAlchemyError as e:
+                current_app.logger.warning(f'Geocoding cache write failed: {e}')
+
+    def fetch(self, key, fetch, negative_ttl=None):
+        """
+        Get the value for a missed `key` from `fetch()` and cache it.
+        Empty values are cached in-process for `negative_ttl` seconds if it is given.
+        """
+        value, shared = self._flight.do(key, lambda: self._fetch_once(key, fetch, negative_ttl))
+        if shared:
+            self.count('coalesced')
+        return value
+
+    def _fetch_once(self, key, fetch, negative_ttl):
+        # The previous leader may have finished right before we became one
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        leased = False
+        if self.persistent:
+            try:
+                leased = self._acquire_lease(key)
+                if not leased:
+                    value = self._wait_for_lease_holder(key)
+                    if value is not None:
+                        self.count('coalesced_across_workers')
+                        self.local.set(key, value)
+                        return value
+            except SQLAlchemyError as e:
+                current_app.logger.warning(f'Geocoding cache lease failed: {e}')
+        try:
+            value = fetch()
+        except Exception:
+            if leased:
+                self._release_lease(key)
+            raise
+        if value or negative_ttl is None:
+            self.set(key, value)
+        else:
+            self.set(key, value, ttl=negative_ttl)
+            if leased:
+                self._release_lease(key)
+        return value
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['local_size'] = len(self.local)
+        return stats
+
+    def _load(self, key):
+        table = GeocodingCacheEntry.__table__
+        with db.engine.connect() as connection:
+            row = connection.execute(
+                db.select([table.c.value]).
+                where(table.c.key == self._persistent_key(key)).
+                where(table.c.value.isnot(None)).
+                where(table.c.updated_at > datetime.utcnow() - timedelta(seconds=self.ttl))
+            ).first()
+        return json.loads(row.value) if row is not None else None
+
+    def _load_many(self, keys):
+        table = GeocodingCacheEntry.__table__
+        persistent_keys = {self._persistent_key(key): key for key in keys}
+        with db.engine.connect() as connection:
+            rows = connection.execute(
+                db.select([table.c.key, table.c.value]).
+                where(table.c.key.in_(list(persistent_keys))).
+                where(table.c.value.isnot(None)).
+                where(table.c.updated_at > datetime.utcnow() - timedelta(seconds=self.ttl))
+            ).fetchall()
+        return {persistent_keys[row.key]: json.loads(row.value) for row in rows}
+
+    def _acquire_lease(self, key):
+        """
+        :return: True if this worker should ask the geocoder, False if another one already does
+        """
+        table = GeocodingCacheEntry.__table__
+        persistent_key = self._persistent_key(key)
+        now = datetime.utcnow()
+        lease_until = now + timedelta(seconds=self.lease_timeout)
+        with db.engine.begin() as connection:
+            taken = connection.execute(
+                table.update().
+                where(table.c.key == persistent_key).
+                where(or_(table.c.lease_until.is_(None), table.c.lease_until < now)).
+                values(lease_until=lease_until)
+            ).rowcount
+            if taken:
+                return True
+            exists = connection.execute(
+                db.select([table.c.key]).where(table.c.key == persistent_key)
+            ).first()
+            if exists:
+                return False
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(table.insert().values(
+                    key=persistent_key, value=None, updated_at=now, lease_until=lease_until
+                ))
+            return True
+        except IntegrityError:
+            return False
+
+    def _wait_for_lease_holder(self, key):
+        """
+        Poll the row until the lease holder stores the answer.
+        `None` means that it failed or timed out, and the caller should ask the geocoder itself.
+        """
+        table = GeocodingCacheEntry.__table__
+        deadline = time.monotonic() + self.lease_timeout
+        while time.monotonic() < deadline:
+            time.sleep(self.lease_poll_interval)
+            with db.engine.connect() as connection:
+                row = connection.execute(
+                    db.select([table.c.value, table.c.updated_at, table.c.lease_until]).
+                    where(table.c.key == self._persistent_key(key))
+                ).first()
+            now = datetime.utcnow()
+            if row is None:
+                return None
+            if row.value is not None and row.updated_at > now - timedelta(seconds=self.ttl):
+                return json.loads(row.value)
+            if row.lease_until is None or row.lease_until < now:
+                return None
+        return None
+
+    def _release_lease(self, key):
+        table = GeocodingCacheEntry.__table__
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    table.update().
+                    where(table.c.key == self._persistent_key(key)).
+                    values(lease_until=None)
+                )
+        except SQLAlchemyError as e:
+            current_app.logger.warning(f'Geocoding cache lease release failed: {e}')
+
+    def _store(self, key, value):
+        table = GeocodingCacheEntry.__table__
+        values = dict(value=json.dumps(value), updated_at=datetime.utcnow(), lease_until=None)
+        persistent_key = self._persistent_key(key)
+        with db.engine.begin() as connection:
+            updated = connection.execute(
+                table.update().where(table.c.key == persistent_key).values(**values)
+            ).rowcount
+            if updated:
+                return
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(table.insert().values(key=persistent_key, **values))
+        except IntegrityError:
+            # Another worker has just stored the same key, its answer is as good as ours
+            pass
+
+
+def forward_geocoding_key(address):
+    """
+    Case- and whitespace-insensitive form of an address query
+    """
+    return ' '.join(address.casefold().split())
+
+
+def reverse_geocoding_key(latitude, longitude, precision):
+    """
+    Quantize coordinates to a grid cell, so that nearby points share one cache entry
+    """
+    return f'{round(float(latitude), precision):.{precision}f},' \
+           f'{round(float(longitude), precision):.{precision}f}'
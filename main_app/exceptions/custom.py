@@ -79,3 +79,8 @@ class RideNotFinished(HTTPException):
 class AlreadyDecided(HTTPException):
     code = 403
     description = 'Join request has already been processed'
+
+
+class DependencyUnavailable(HTTPException):
+    code = 503
+    description = 'External service is unavailable, try again later'
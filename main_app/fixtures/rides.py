@@ -2,6 +2,7 @@ import factory.fuzzy
 from datetime import datetime, timedelta
 
 from main_app.model import Ride, RideFeedback
+from main_app.misc import reverse_geocoding_blocking
 from app import db
 
 
@@ -11,6 +12,10 @@ class RideFactory(factory.alchemy.SQLAlchemyModelFactory):
         sqlalchemy_session = db.session
     latitude = factory.fuzzy.FuzzyFloat(55.0, 56.0)
     longitude = factory.fuzzy.FuzzyFloat(37.0, 38.0)
+    address = factory.lazy_attribute(
+        lambda o: reverse_geocoding_blocking(
+            latitude=o.latitude, longitude=o.longitude)['address']
+    )
     submit_datetime = datetime.now().isoformat()
     start_datetime = datetime.now() + timedelta(minutes=factory.fuzzy.random.randgen.randint(5, 10))
     from_organization = factory.Iterator([True, False])
@@ -37,6 +42,7 @@ class RideFactory(factory.alchemy.SQLAlchemyModelFactory):
         if extracted:
             for user in extracted:
                 self.passengers.append(user)
+            self.occupied_seats = len(self.passengers)
 
 
 class RideFeedbackFactory(factory.alchemy.SQLAlchemyModelFactory):
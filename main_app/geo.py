@@ -0,0 +1,33 @@
+import math
+
+EARTH_RADIUS_KM = 6371.0
+# Length of one degree of latitude
+KM_PER_DEGREE = 111.045
+
+
+def haversine_km(latitude1, longitude1, latitude2, longitude2):
+    """
+    Great-circle distance, see `Ride.distance_to` for the SQL version
+    """
+    latitude1, longitude1, latitude2, longitude2 = map(
+        math.radians, (latitude1, longitude1, latitude2, longitude2))
+    a = math.sin((latitude2 - latitude1) / 2) ** 2 + \
+        math.cos(latitude1) * math.cos(latitude2) * math.sin((longitude2 - longitude1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """
+    Lat/lon box that contains the circle of `radius_km` around the point,
+    cheap to check before computing exact distances
+
+    :return: (min_latitude, max_latitude, min_longitude, max_longitude)
+    """
+    delta_latitude = radius_km / KM_PER_DEGREE
+    # Longitude degrees shrink towards the poles
+    delta_longitude = min(
+        radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 1e-6)), 180.)
+    return (
+        latitude - delta_latitude, latitude + delta_latitude,
+        longitude - delta_longitude, longitude + delta_longitude,
+    )
@@ -0,0 +1,96 @@
+from collections import namedtuple
+
+import numpy as np
+
+from main_app.geo import EARTH_RADIUS_KM
+
+# Parallel arrays, one item per candidate ride
+Candidates = namedtuple('Candidates', [
+    'ids', 'latitudes', 'longitudes', 'start_timestamps', 'prices', 'free_seats',
+])
+
+
+def candidates_from_rows(rows):
+    """
+    :param rows: `(id, latitude, longitude, start_datetime, price, free_seats)` tuples
+    """
+    rows = list(rows)
+    return Candidates(
+        ids=np.array([row[0] for row in rows], dtype=np.int64),
+        latitudes=np.array([row[1] for row in rows], dtype=np.float64),
+        longitudes=np.array([row[2] for row in rows], dtype=np.float64),
+        start_timestamps=np.array([row[3].timestamp() for row in rows], dtype=np.float64),
+        prices=np.array([row[4] for row in rows], dtype=np.float64),
+        free_seats=np.array([row[5] for row in rows], dtype=np.float64),
+    )
+
+
+def haversine_km(latitude, longitude, latitudes, longitudes):
+    """
+    Vectorized `main_app.geo.haversine_km` from one point to arrays of points
+    """
+    latitude, longitude = np.radians(latitude), np.radians(longitude)
+    latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+    a = np.sin((latitudes - latitude) / 2) ** 2 + \
+        np.cos(latitude) * np.cos(latitudes) * np.sin((longitudes - longitude) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+class MatchingEngine:
+    """
+    Scores candidate rides for a passenger, the lower the better:
+
+        distance_weight * km to the pickup point
+        + time_weight * minutes between the wanted and the ride start
+        + price_weight * price
+        - seats_weight * free seats
+
+    The default weights (see `settings.Config.MATCH_*_WEIGHT`) rank by distance only.
+    """
+
+    def __init__(self, distance_weight=1., time_weight=0., price_weight=0., seats_weight=0.):
+        self.distance_weight = distance_weight
+        self.time_weight = time_weight
+        self.price_weight = price_weight
+        self.seats_weight = seats_weight
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            distance_weight=config['MATCH_DISTANCE_WEIGHT'],
+            time_weight=config['MATCH_TIME_WEIGHT'],
+            price_weight=config['MATCH_PRICE_WEIGHT'],
+            seats_weight=config['MATCH_SEATS_WEIGHT'],
+        )
+
+    def score(self, candidates, latitude, longitude, start_datetime):
+        scores = self.distance_weight * haversine_km(
+            latitude, longitude, candidates.latitudes, candidates.longitudes)
+        if self.time_weight:
+            scores += self.time_weight * np.abs(
+                candidates.start_timestamps - start_datetime.timestamp()) / 60
+        if self.price_weight:
+            scores += self.price_weight * candidates.prices
+        if self.seats_weight:
+            scores -= self.seats_weight * candidates.free_seats
+        return scores
+
+    def top_k(self, candidates, latitude, longitude, start_datetime, k, after=None):
+        """
+        :param after: `(score, id)` of the last ride of the previous page
+        :return: `(score, id)` pairs of the best `k` rides, ties are broken by id
+        """
+        scores = self.score(candidates, latitude, longitude, start_datetime)
+        ids = candidates.ids
+        if after is not None:
+            last_score, last_id = after
+            mask = (scores > last_score) | ((scores == last_score) & (ids > last_id))
+            scores, ids = scores[mask], ids[mask]
+        if len(scores) > k:
+            # O(n) selection of the k best, only they are sorted.
+            # Rides tied with the k-th one are kept, so the id tie-break below stays exact.
+            kth = np.partition(scores, k - 1)[k - 1]
+            mask = scores <= kth
+            scores, ids = scores[mask], ids[mask]
+        order = np.lexsort((ids, scores))[:k]
+        return [(float(scores[i]), int(ids[i])) for i in order]
@@ -1,8 +1,10 @@
 import os
-import requests
 from flask import current_app
 from werkzeug.exceptions import BadRequest
 
+from main_app.cache import reverse_geocoding_key, forward_geocoding_key
+from main_app.exceptions.custom import DependencyUnavailable
+
 
 def get_distance(coords1, coords2):
     return ((coords1[0] - coords2[0]) ** 2 + (coords1[1] - coords2[1]) ** 2) ** 0.5
@@ -11,7 +13,10 @@ def get_distance(coords1, coords2):
 REVERSE_GEOCODING_URL = 'https://geocode-maps.yandex.ru/1.x/?apikey={key}&' \
                         'format=json&geocode={longitude},{latitude}'
 FORWARD_GEOCODING_URL = 'https://geocode-maps.yandex.ru/1.x/?apikey={key}&bbox=37.144775,' \
-                        '55.561263~38.070374,56.059769&rspn=1&format=json&geocode={address}'
+                        '55.561263~38.070374,56.059769&rspn=1&format=json&results={results}&' \
+                        'geocode={address}'
+# Max results of a forward geocoding answer, a shorter answer holds every match
+FORWARD_GEOCODING_RESULTS = 10
 GEO_TOKEN = os.environ['GEOCODING_KEY']
 
 
@@ -25,30 +30,149 @@ def _parse_geocoding_results(response):
     ) for x in response['response']['GeoObjectCollection']['featureMember']]
 
 
-def reverse_geocoding_blocking(latitude, longitude):
-    yandex_response = requests.get(
-        REVERSE_GEOCODING_URL.format(key=GEO_TOKEN, latitude=latitude, longitude=longitude)
-    ).json()
+def _yandex_request(url):
+    response = current_app.outbound.get('yandex', url)
+    try:
+        yandex_response = response.json()
+    except ValueError:
+        raise DependencyUnavailable(f'Yandex error: HTTP {response.status_code}')
     if 'error' in yandex_response:
         raise BadRequest(f"Yandex error: {yandex_response.get('message')}")
+    return yandex_response
+
+
+def _reverse_geocoding_request(latitude, longitude):
+    yandex_response = _yandex_request(
+        REVERSE_GEOCODING_URL.format(key=GEO_TOKEN, latitude=latitude, longitude=longitude)
+    )
     results = _parse_geocoding_results(yandex_response)
     # NOTE: we assume that first list element is nearest element
     return results[0]
 
 
-def forward_geocoding_blocking(address):
-    yandex_response = requests.get(
-        FORWARD_GEOCODING_URL.format(key=GEO_TOKEN, address=address)
-    ).json()
-    if 'error' in yandex_response:
-        raise BadRequest(f"Yandex error: {yandex_response.get('message')}")
+def _degraded_reverse_result(latitude, longitude):
+    return dict(
+        address=f'{latitude}, {longitude}',
+        gps=dict(latitude=str(latitude), longitude=str(longitude)),
+    )
+
+
+def _resolve_missed(cache, key, latitude, longitude, degrade):
+    try:
+        return cache.fetch(key, lambda: _reverse_geocoding_request(
+            latitude=latitude, longitude=longitude))
+    except DependencyUnavailable:
+        result = cache.get_stale(key)
+        if result is not None:
+            return result
+        if not degrade:
+            raise
+        return _degraded_reverse_result(latitude, longitude)
+
+
+def reverse_geocoding_blocking(latitude, longitude, degrade=True):
+    """
+    :param degrade: while Yandex is unavailable, answer with raw coordinates instead of
+        an address. Otherwise `DependencyUnavailable` is raised, use it when the answer is stored.
+    """
+    cache = current_app.reverse_geocoding_cache
+    key = reverse_geocoding_key(
+        latitude, longitude, current_app.config['GEOCODING_CACHE_PRECISION'])
+    result = cache.get(key)
+    if result is None:
+        result = _resolve_missed(cache, key, latitude, longitude, degrade)
+    return result
+
+
+def reverse_geocoding_batch(coordinates, degrade=True):
+    """
+    Resolve many `(latitude, longitude)` pairs at once. Pairs that fall into the same cache cell
+    are resolved once, cached cells are not fetched (the cache table is read with one query),
+    the rest are fetched concurrently on the shared geocoding thread pool.
+
+    :param degrade: same as for `reverse_geocoding_blocking`
+    :return: results in the order of `coordinates`
+    """
+    app = current_app._get_current_object()
+    cache = app.reverse_geocoding_cache
+    precision = app.config['GEOCODING_CACHE_PRECISION']
+    keys = [reverse_geocoding_key(latitude, longitude, precision)
+            for latitude, longitude in coordinates]
+    results = cache.get_many(keys)
+    misses = {}
+    for key, (latitude, longitude) in zip(keys, coordinates):
+        if key not in results:
+            misses.setdefault(key, (latitude, longitude))
+
+    def resolve(key, latitude, longitude):
+        with app.app_context():
+            return _resolve_missed(cache, key, latitude, longitude, degrade)
+
+    futures = {
+        key: app.geocoding_executor.submit(resolve, key, latitude, longitude)
+        for key, (latitude, longitude) in misses.items()
+    }
+    for key, future in futures.items():
+        results[key] = future.result()
+    return [results[key] for key in keys]
+
+
+def _forward_geocoding_request(address):
+    yandex_response = _yandex_request(
+        FORWARD_GEOCODING_URL.format(
+            key=GEO_TOKEN, results=FORWARD_GEOCODING_RESULTS, address=address)
+    )
     results = _parse_geocoding_results(yandex_response)
     return results
 
 
+def _reuse_prefix_candidates(cache, query):
+    """
+    Autocomplete sends a query on every keystroke, so a shorter prefix of `query`
+    is usually cached already. Its candidates that still contain every word of `query`
+    are returned, `None` means that Yandex has to be asked.
+    A full answer may have left out matches of `query`, so it is not reused.
+    """
+    words = query.split(' ')
+    for end in range(len(query) - 1, current_app.config['GEOCODING_PREFIX_MIN_LENGTH'] - 1, -1):
+        candidates = cache.local.get(query[:end])
+        if candidates is None:
+            continue
+        if len(candidates) >= FORWARD_GEOCODING_RESULTS:
+            return None
+        matching = [
+            x for x in candidates
+            if all(word in forward_geocoding_key(x['address']) for word in words)
+        ]
+        # Only the longest cached prefix is considered
+        return matching or None
+    return None
+
+
+def forward_geocoding_blocking(address):
+    cache = current_app.forward_geocoding_cache
+    query = forward_geocoding_key(address)
+    results = cache.get(query)
+    if results is not None:
+        return results
+    results = _reuse_prefix_candidates(cache, query)
+    if results is not None:
+        cache.count('prefix_hits')
+        return results
+    try:
+        return cache.fetch(
+            query, lambda: _forward_geocoding_request(query),
+            negative_ttl=current_app.config['GEOCODING_NEGATIVE_CACHE_TTL']
+        )
+    except DependencyUnavailable:
+        # Degraded answer, the client can still let the user type the address
+        stale = cache.get_stale(query)
+        return stale if stale is not None else []
+
+
 def notify_at(timestamp, user_id, title, message):
-    response = requests.get(
-        f"{current_app.config['FCM_BACKEND_URL']}/send_at",
+    response = current_app.outbound.get(
+        'fcm', f"{current_app.config['FCM_BACKEND_URL']}/send_at",
         params={'id': user_id, 'title': title, 'message': message, 'timestamp': timestamp}
     )
     current_app.logger.info(f'response from FCM: {(response.content, response.status_code)}')
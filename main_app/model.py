@@ -1,25 +1,26 @@
 from flask_login import UserMixin, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.orm import validates
-from main_app.misc import reverse_geocoding_blocking
+from sqlalchemy.orm import column_property, validates
 from datetime import datetime
 
 from main_app.search import query_index, add_to_index, remove_from_index
+from main_app.geo import EARTH_RADIUS_KM, haversine_km
 from app import db
 from settings import MAX_EMAIL_LENGTH, MAX_NAME_LENGTH, MAX_SURNAME_LENGTH, MAX_URL_LENGTH
 
 association_user_ride = db.Table(
     'association_user_ride', db.metadata,
-    db.Column('left_id', db.Integer, db.ForeignKey(f'user.id')),
-    db.Column('right_id', db.Integer, db.ForeignKey('ride.id'))
+    db.Column('left_id', db.Integer, db.ForeignKey(f'user.id'), index=True),
+    db.Column('right_id', db.Integer, db.ForeignKey('ride.id'), index=True)
 )
 
 association_user_organization = db.Table(
     'association_user_organization', db.metadata,
-    db.Column('left_id', db.Integer, db.ForeignKey('user.id', ondelete='cascade')),
-    db.Column('right_id', db.Integer, db.ForeignKey('organization.id', ondelete='cascade'))
+    db.Column('left_id', db.Integer, db.ForeignKey('user.id', ondelete='cascade'), index=True),
+    db.Column('right_id', db.Integer, db.ForeignKey('organization.id', ondelete='cascade'),
+              index=True)
 )
 
 
@@ -71,12 +72,27 @@ db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
 class RatingMixin:
     """
     Mixin for rating calculation. Class should have `reviews` field.
+
+    The sum and the number of `reviews` rates are stored on the row and kept up to date
+    by `track_rating`, so reading a rating does not load the reviews.
     """
+    rating_sum = db.Column(db.Integer, nullable=False, server_default='0')
+    rating_count = db.Column(db.Integer, nullable=False, server_default='0')
+    # Internal counters, clients only see `rating`
+    __rating_counters__ = ('rating_sum', 'rating_count')
+
     @hybrid_property
     def rating(self):
-        if not self.reviews:
+        if not self.rating_count:
             return 0.
-        return sum([x.rate for x in self.reviews]) / len(self.reviews)
+        return self.rating_sum / self.rating_count
+
+    @rating.expression
+    def rating(cls):
+        return db.case(
+            [(cls.rating_count > 0, db.cast(cls.rating_sum, db.Float) / cls.rating_count)],
+            else_=0.
+        )
 
 
 class User(SearchableMixin, UserMixin, RatingMixin, db.Model):
@@ -86,7 +102,8 @@ class User(SearchableMixin, UserMixin, RatingMixin, db.Model):
     last_name = db.Column(db.String(MAX_SURNAME_LENGTH), nullable=False)
     email = db.Column(db.String(MAX_EMAIL_LENGTH), nullable=False, unique=True)
     photo_url = db.Column(db.String(MAX_URL_LENGTH))
-    phone_number = db.Column(db.String(20), server_default='+71111111111', nullable=False)
+    phone_number = db.Column(
+        db.String(20), server_default='+71111111111', nullable=False, index=True)
     _password_hash = db.Column(db.String(94), nullable=False)
     about = db.Column(db.String(400))
 
@@ -103,6 +120,10 @@ class User(SearchableMixin, UserMixin, RatingMixin, db.Model):
 
 
 class JoinRideRequest(db.Model):
+    # Lookups by `user_id` are served by the primary key
+    __table_args__ = (
+        db.Index('ix_join_ride_request_ride_id_status', 'ride_id', 'status'),
+    )
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, primary_key=True)
     user = db.relationship('User', backref='join_requests')
     ride_id = db.Column(db.Integer, db.ForeignKey('ride.id'), nullable=False, primary_key=True)
@@ -111,6 +132,36 @@ class JoinRideRequest(db.Model):
     status = db.Column(db.Integer, nullable=False, server_default='0')
     decline_reason = db.Column(db.String(200))
 
+    @property
+    def host_answer(self):
+        return {1: 'ACCEPTED', 0: 'NO ANSWER', -1: 'DECLINED'}.get(self.status)
+
+    @classmethod
+    def decide(cls, ride_id, user_ids, status, decline_reason=None):
+        """
+        Move the undecided requests of `user_ids` to `ride_id` to `status` with a conditional
+        UPDATE, so of concurrent decisions on a request only one wins.
+
+        :return: ids of the users whose requests were moved by this call
+        """
+        values = {'status': status}
+        if decline_reason is not None:
+            values['decline_reason'] = decline_reason
+        table = cls.__table__
+        condition = db.and_(
+            table.c.ride_id == ride_id, table.c.status == 0, table.c.user_id.in_(user_ids))
+        if db.engine.dialect.implicit_returning:
+            result = db.session.execute(
+                table.update().where(condition).values(values).returning(table.c.user_id))
+            return [user_id for user_id, in result]
+        # Without RETURNING the winners are only known from the row count of every UPDATE
+        return [
+            user_id for user_id in user_ids
+            if db.session.execute(table.update().where(db.and_(
+                table.c.ride_id == ride_id, table.c.status == 0, table.c.user_id == user_id,
+            )).values(values)).rowcount
+        ]
+
 
 class Organization(SearchableMixin, db.Model):
     __searchable__ = ['name', 'address']
@@ -137,44 +188,75 @@ class Organization(SearchableMixin, db.Model):
             self.users.append(value)
         return value
 
+    # Summary columns, see `_organization_stats` below
+    __stats__ = (
+        'stats_last_ride_datetime', 'stats_total_members', 'stats_total_drivers',
+        'stats_min_ride_cost', 'stats_max_ride_cost',
+    )
+
     @hybrid_property
     def last_ride_datetime(self):
         # TODO: спроси, только по исходящим считать или по всем
-        return max([x.submit_datetime for x in self.rides]) if self.rides else '-'
+        return '-' if self.stats_last_ride_datetime is None else self.stats_last_ride_datetime
+
+    @last_ride_datetime.expression
+    def last_ride_datetime(cls):
+        return cls.stats_last_ride_datetime
 
     @hybrid_property
     def total_members(self):
-        return len(self.users)
+        return self.stats_total_members
 
     @hybrid_property
     def total_drivers(self):
-        return sum([len(user.cars) > 0 for user in self.users])
+        return self.stats_total_drivers
 
     @hybrid_property
     def min_ride_cost(self):
         # TODO: спроси, только по исходящим считать или по всем
-        return min([x.price for x in self.rides]) if self.rides else '-'
+        return '-' if self.stats_min_ride_cost is None else self.stats_min_ride_cost
+
+    @min_ride_cost.expression
+    def min_ride_cost(cls):
+        return cls.stats_min_ride_cost
 
     @hybrid_property
     def max_ride_cost(self):
         # TODO: спроси, только по исходящим считать или по всем
-        return max([x.price for x in self.rides]) if self.rides else '-'
+        return '-' if self.stats_max_ride_cost is None else self.stats_max_ride_cost
+
+    @max_ride_cost.expression
+    def max_ride_cost(cls):
+        return cls.stats_max_ride_cost
 
 
 class Ride(RatingMixin, db.Model):
+    __table_args__ = (
+        # `/ride/match` prefilter
+        db.Index('ix_ride_active_match', 'organization_id', 'from_organization', 'start_datetime',
+                 postgresql_where=db.text('is_active'), sqlite_where=db.text('is_active')),
+        # `/ride/hosted`
+        db.Index('ix_ride_active_host', 'host_id', 'start_datetime', 'id',
+                 postgresql_where=db.text('is_active'), sqlite_where=db.text('is_active')),
+    )
     id = db.Column(db.Integer, primary_key=True)
 
-    organization_id = db.Column(db.Integer, db.ForeignKey('organization.id'), nullable=False)
+    organization_id = db.Column(
+        db.Integer, db.ForeignKey('organization.id'), nullable=False, index=True)
     organization = db.relationship(
         'Organization', backref='rides', foreign_keys=[organization_id])
 
     latitude = db.Column(db.Float, nullable=False)
     longitude = db.Column(db.Float, nullable=False)
+    # Resolved once on creation, see `backfill_ride_addresses` in `manage.py` for old rows
+    address = db.Column(db.String(600))
     submit_datetime = db.Column(db.DateTime, server_default=datetime.now().isoformat())
     start_datetime = db.Column(db.DateTime, nullable=False)
     stop_datetime = db.Column(db.DateTime)
 
     total_seats = db.Column(db.Integer, server_default='4', nullable=False)
+    # Number of `passengers`, taken only with `reserve_seats`
+    occupied_seats = db.Column(db.Integer, server_default='0', nullable=False)
     host_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     host = db.relationship('User', backref='hosted_rides')
     passengers = db.relationship('User', secondary=association_user_ride, backref='all_rides')
@@ -189,13 +271,41 @@ class Ride(RatingMixin, db.Model):
 
     @hybrid_property
     def free_seats(self):
-        return self.total_seats - len(self.passengers)
-
-    @hybrid_property
-    def address(self):
-        return reverse_geocoding_blocking(
-            latitude=self.latitude, longitude=self.longitude
-        )['address']
+        return self.total_seats - self.occupied_seats
+
+    @free_seats.expression
+    def free_seats(cls):
+        return cls.total_seats - cls.occupied_seats
+
+    def reserve_seats(self, count=1):
+        """
+        Take `count` seats with a single conditional UPDATE, so concurrent accepts cannot overbook:
+        the row lock makes them wait for each other and re-check the condition.
+
+        :return: False if there are not enough free seats, none is taken then
+        """
+        reserved = db.session.query(Ride).\
+            filter(Ride.id == self.id).\
+            filter(Ride.occupied_seats + count <= Ride.total_seats).\
+            update({Ride.occupied_seats: Ride.occupied_seats + count}, synchronize_session=False)
+        db.session.expire(self, ['occupied_seats'])
+        return bool(reserved)
+
+    @hybrid_method
+    def distance_to(self, latitude, longitude):
+        """
+        Great-circle distance in km from the ride start/finish point
+        """
+        return haversine_km(self.latitude, self.longitude, latitude, longitude)
+
+    @distance_to.expression
+    def distance_to(cls, latitude, longitude):
+        half_delta_latitude = db.func.radians(cls.latitude - latitude) / 2
+        half_delta_longitude = db.func.radians(cls.longitude - longitude) / 2
+        a = db.func.power(db.func.sin(half_delta_latitude), 2) + \
+            db.func.cos(db.func.radians(latitude)) * db.func.cos(db.func.radians(cls.latitude)) * \
+            db.func.power(db.func.sin(half_delta_longitude), 2)
+        return 2 * EARTH_RADIUS_KM * db.func.asin(db.func.sqrt(a))
 
     @hybrid_property
     def is_mine(self):
@@ -203,15 +313,38 @@ class Ride(RatingMixin, db.Model):
 
     @hybrid_property
     def host_answer(self):
-        for request in self.join_requests:
-            if request.user == current_user:
-                return {1: 'ACCEPTED', 0: 'NO ANSWER', -1: 'DECLINED'}.get(request.status)
+        request = current_user_join_request(self)
+        if request is not None:
+            return request.host_answer
 
     @hybrid_property
     def decline_reason(self):
-        for request in self.join_requests:
-            if request.user == current_user:
-                return request.decline_reason or ''
+        request = current_user_join_request(self)
+        if request is not None:
+            return request.decline_reason or ''
+
+
+def current_user_join_request(ride):
+    """
+    :return: join request of the current user to `ride` or `None`
+    """
+    return next((x for x in ride.join_requests if x.user == current_user), None)
+
+
+def current_user_join_requests(rides):
+    """
+    Join requests of the current user to all `rides` with one query
+
+    :return: `{ride id: join request}`, rides without a request are missing
+    """
+    ride_ids = {ride.id for ride in rides}
+    if not ride_ids or not current_user.is_authenticated:
+        return {}
+    return {
+        request.ride_id: request for request in db.session.query(JoinRideRequest).
+        filter(JoinRideRequest.user_id == current_user.id).
+        filter(JoinRideRequest.ride_id.in_(ride_ids))
+    }
 
 
 class Car(db.Model):
@@ -219,10 +352,41 @@ class Car(db.Model):
     model = db.Column(db.String(100), nullable=False)
     color = db.Column(db.String(100), nullable=False)
     registry_number = db.Column(db.String(20), nullable=False)
-    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     owner = db.relationship('User', backref='cars')
 
 
+def _organization_stats():
+    """
+    Organization summary as correlated SQL aggregates instead of loading all members,
+    their cars and all rides. The columns are deferred into the `stats` group:
+    the first access loads all of them with one query, `undefer_group('stats')` loads them
+    together with the organization.
+    """
+    members = association_user_organization
+    rides = Ride.__table__
+
+    def stat(expression):
+        return column_property(expression.as_scalar(), deferred=True, group='stats')
+
+    Organization.stats_total_members = stat(
+        db.select([db.func.count()]).where(members.c.right_id == Organization.id))
+    Organization.stats_total_drivers = stat(
+        db.select([db.func.count(db.distinct(members.c.left_id))]).
+        select_from(members.join(Car.__table__, Car.owner_id == members.c.left_id)).
+        where(members.c.right_id == Organization.id))
+    Organization.stats_last_ride_datetime = stat(
+        db.select([db.func.max(rides.c.submit_datetime)]).
+        where(rides.c.organization_id == Organization.id))
+    Organization.stats_min_ride_cost = stat(
+        db.select([db.func.min(rides.c.price)]).where(rides.c.organization_id == Organization.id))
+    Organization.stats_max_ride_cost = stat(
+        db.select([db.func.max(rides.c.price)]).where(rides.c.organization_id == Organization.id))
+
+
+_organization_stats()
+
+
 class FeedbackMixin:
 
     @declared_attr
@@ -244,17 +408,66 @@ class FeedbackMixin:
 
 
 class UserFeedback(FeedbackMixin, db.Model):
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user = db.relationship(User, backref='reviews', foreign_keys=[user_id, ])
 
 
 class RideFeedback(FeedbackMixin, db.Model):
-    ride_id = db.Column(db.Integer, db.ForeignKey('ride.id'), nullable=False)
+    ride_id = db.Column(db.Integer, db.ForeignKey('ride.id'), nullable=False, index=True)
     ride = db.relationship(Ride, backref='reviews')
 
 
+def track_rating(feedback_model, rated_model, foreign_key):
+    """
+    Keep `rated_model.rating_sum`/`rating_count` in sync with `feedback_model` rows.
+    The counters are updated with SQL in the same flush, hence in the same transaction.
+    """
+    table = rated_model.__table__
+
+    def change(connection, rated_id, rate, count):
+        connection.execute(table.update().where(table.c.id == rated_id).values(
+            rating_sum=table.c.rating_sum + rate,
+            rating_count=table.c.rating_count + count,
+        ))
+
+    def previous(target, name):
+        deleted = db.inspect(target).attrs[name].history.deleted
+        return deleted[0] if deleted else getattr(target, name)
+
+    @db.event.listens_for(feedback_model, 'after_insert')
+    def after_insert(mapper, connection, target):
+        change(connection, getattr(target, foreign_key), target.rate, 1)
+
+    @db.event.listens_for(feedback_model, 'after_delete')
+    def after_delete(mapper, connection, target):
+        change(connection, getattr(target, foreign_key), -target.rate, -1)
+
+    @db.event.listens_for(feedback_model, 'after_update')
+    def after_update(mapper, connection, target):
+        old_id, old_rate = previous(target, foreign_key), previous(target, 'rate')
+        new_id, new_rate = getattr(target, foreign_key), target.rate
+        if (old_id, old_rate) != (new_id, new_rate):
+            change(connection, old_id, -old_rate, -1)
+            change(connection, new_id, new_rate, 1)
+
+
+track_rating(UserFeedback, User, 'user_id')
+track_rating(RideFeedback, Ride, 'ride_id')
+
+
 class FirebaseIds(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'),
                         primary_key=True, nullable=False)
     user = db.relationship(User, backref='firebase_id')
     firebase_id = db.Column(db.String(300), nullable=False)
+
+
+class GeocodingCacheEntry(db.Model):
+    __tablename__ = 'geocoding_cache'
+    # `<namespace>:<key>`, e.g. `reverse:55.7558,37.6173`
+    key = db.Column(db.String(700), primary_key=True)
+    # NULL while the first lookup is in flight
+    value = db.Column(db.Text)
+    updated_at = db.Column(db.DateTime, nullable=False)
+    # Set by the worker that is asking the geocoder right now, see `GeocodingCache.fetch`
+    lease_until = db.Column(db.DateTime)
@@ -0,0 +1,236 @@
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from main_app.exceptions.custom import DependencyUnavailable
+
+# Only these are retried, a retried POST could e.g. schedule the same notification twice
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+RETRY_STATUSES = (502, 503, 504)
+
+# `method_whitelist` was renamed in urllib3 1.26
+try:
+    Retry(allowed_methods=IDEMPOTENT_METHODS)
+    _RETRY_METHODS_ARG = 'allowed_methods'
+except TypeError:
+    _RETRY_METHODS_ARG = 'method_whitelist'
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second on average and bursts of up to `capacity` calls.
+    `rate` <= 0 disables the limit.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls for `reset_timeout`
+    seconds. Then a single trial call is let through: success closes the breaker,
+    failure opens it again. `failure_threshold` <= 0 disables the breaker.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.OPEN or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.failure_threshold > 0 and (
+                    self._trial_in_flight or self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class DependencyGuard:
+    """
+    Rate limiter and circuit breaker of a single dependency.
+    Rejected calls fail fast with `DependencyUnavailable`.
+    """
+
+    def __init__(self, name, rate_limiter, breaker):
+        self.name = name
+        self.rate_limiter = rate_limiter
+        self.breaker = breaker
+        self.rejected = 0
+
+    def call(self, func, failure_exceptions=(Exception, ), is_failure=None):
+        """
+        :param failure_exceptions: exceptions of `func` that count as dependency failures
+        :param is_failure: predicate on the result of `func` that marks it as a failure
+        """
+        if not self.rate_limiter.try_acquire():
+            self.rejected += 1
+            raise DependencyUnavailable(f'{self.name} rate limit exceeded')
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise DependencyUnavailable(f'{self.name} is unavailable (circuit is open)')
+        try:
+            result = func()
+        except failure_exceptions:
+            self.breaker.record_failure()
+            raise
+        except Exception:
+            self.breaker.record_success()
+            raise
+        if is_failure is not None and is_failure(result):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return result
+
+    def stats(self):
+        return {'state': self.breaker.state, 'rejected': self.rejected}
+
+
+class OutboundClient:
+    """
+    Per-process client for external services (dependencies).
+
+    Every HTTP dependency gets its own keep-alive `requests.Session` with a connection pool,
+    its own timeouts and retry policy. Every dependency, HTTP or not, gets a `DependencyGuard`.
+    All of it is read from `<DEPENDENCY>_*` config keys. Sessions and guards are created lazily
+    and re-created after fork, so they are never shared between gunicorn workers,
+    and rate limits are per worker.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._sessions = {}
+        self._guards = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _setting(self, dependency, name):
+        return self.config[f'{dependency.upper()}_{name}']
+
+    def _ensure_process(self):
+        if self._pid != os.getpid():
+            self._sessions = {}
+            self._guards = {}
+            self._pid = os.getpid()
+
+    def _session(self, dependency):
+        with self._lock:
+            self._ensure_process()
+            if dependency not in self._sessions:
+                self._sessions[dependency] = self._make_session(dependency)
+            return self._sessions[dependency]
+
+    def guard(self, dependency):
+        with self._lock:
+            self._ensure_process()
+            if dependency not in self._guards:
+                self._guards[dependency] = DependencyGuard(
+                    dependency,
+                    TokenBucket(
+                        rate=self._setting(dependency, 'RATE_LIMIT'),
+                        capacity=self._setting(dependency, 'RATE_BURST'),
+                    ),
+                    CircuitBreaker(
+                        failure_threshold=self._setting(dependency, 'BREAKER_THRESHOLD'),
+                        reset_timeout=self._setting(dependency, 'BREAKER_RESET_TIMEOUT'),
+                    ),
+                )
+            return self._guards[dependency]
+
+    def stats(self):
+        with self._lock:
+            guards = dict(self._guards)
+        return {name: guard.stats() for name, guard in guards.items()}
+
+    def _make_session(self, dependency):
+        retry = Retry(
+            total=self._setting(dependency, 'RETRIES'),
+            backoff_factor=self.config['OUTBOUND_RETRY_BACKOFF'],
+            status_forcelist=RETRY_STATUSES,
+            raise_on_status=False,
+            **{_RETRY_METHODS_ARG: IDEMPOTENT_METHODS}
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.config['OUTBOUND_POOL_SIZE'],
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def request(self, dependency, method, url, **kwargs):
+        kwargs.setdefault('timeout', (
+            self._setting(dependency, 'CONNECT_TIMEOUT'),
+            self._setting(dependency, 'READ_TIMEOUT'),
+        ))
+
+        def send():
+            try:
+                return self._session(dependency).request(method, url, **kwargs)
+            except requests.RequestException as e:
+                raise DependencyUnavailable(f'{dependency} is unavailable: {type(e).__name__}')
+
+        return self.guard(dependency).call(
+            send,
+            failure_exceptions=(DependencyUnavailable, ),
+            # 429 means that our quota is exhausted, backing off is the right thing to do
+            is_failure=lambda response: response.status_code >= 500 or response.status_code == 429
+        )
+
+    def get(self, dependency, url, **kwargs):
+        return self.request(dependency, 'GET', url, **kwargs)
+
+    def post(self, dependency, url, **kwargs):
+        return self.request(dependency, 'POST', url, **kwargs)
@@ -0,0 +1,121 @@
+import base64
+import json
+from datetime import datetime
+
+from flask import Response, json as flask_json, stream_with_context
+from marshmallow import ValidationError
+from sqlalchemy import and_, or_
+
+# Clients get the cursor of the next page in this header, the body stays a plain list
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return {'$dt': value.isoformat()}
+    raise TypeError(f'Cannot encode {type(value).__name__} in a cursor')
+
+
+def _object_hook(obj):
+    if '$dt' in obj:
+        return datetime.fromisoformat(obj['$dt'])
+    return obj
+
+
+def encode_cursor(values):
+    """
+    Opaque cursor for keyset pagination: sort key values of the last returned row
+    """
+    payload = json.dumps(list(values), default=_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()), object_hook=_object_hook)
+    except (ValueError, TypeError):
+        raise ValidationError('Invalid cursor')
+
+
+def with_next_cursor(response, cursor):
+    if cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
+    return response
+
+
+def stream_json_array(items, schema):
+    """
+    Chunked JSON array of `schema.dump(item)`, items are serialized one by one as the
+    client reads the response, so only the current one is kept in memory
+    """
+    def generate():
+        yield '['
+        for i, item in enumerate(items):
+            yield (',' if i else '') + flask_json.dumps(schema.dump(item))
+        yield ']'
+
+    # The request context, and so the DB session, lives until the last chunk is sent
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def _after(columns, values, descending):
+    """
+    Condition "the row goes after `values` in `columns` order", expanded into
+    `a > x OR (a = x AND b > y) ...` as not every backend compares row values
+    """
+    conditions = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        equal = [c == v for c, v in zip(columns[:i], values[:i])]
+        conditions.append(and_(*equal, column < value if descending else column > value))
+    return or_(*conditions)
+
+
+def _has_type(column, value):
+    python_type = column.type.python_type
+    # `True` is an `int` too
+    if isinstance(value, bool) and python_type is not bool:
+        return False
+    if python_type is float:
+        return isinstance(value, (int, float))
+    return isinstance(value, python_type)
+
+
+def paginate(query, columns, cursor, limit, descending=False):
+    """
+    Keyset pagination of `query` ordered by `columns`, the last one must be unique
+
+    :param cursor: decoded cursor of the previous page or `None` for the first one
+    :return: pair `(items, next_cursor)`, `next_cursor` is `None` on the last page
+    """
+    if cursor is not None:
+        if len(cursor) != len(columns) or \
+                not all(_has_type(column, value) for column, value in zip(columns, cursor)):
+            raise ValidationError('Invalid cursor')
+        query = query.filter(_after(columns, cursor, descending))
+    order = [column.desc() if descending else column for column in columns]
+    # One extra row tells whether there is a next page
+    items = query.order_by(*order).limit(limit + 1).all()
+    if len(items) <= limit:
+        return items, None
+    items = items[:limit]
+    return items, encode_cursor(getattr(items[-1], column.key) for column in columns)
+
+
+def paginate_search(model, expression, cursor, limit):
+    """
+    Pagination of `SearchableMixin.search` results, they are ranked by Elasticsearch
+    so the cursor holds the number of the next page
+
+    :return: pair `(items, next_cursor)` like `paginate`
+    """
+    if cursor is None:
+        page = 1
+    elif len(cursor) != 1 or not isinstance(cursor[0], int) or cursor[0] < 1:
+        raise ValidationError('Invalid cursor')
+    else:
+        page, = cursor
+    items, total = model.search(expression, page, limit)
+    # A dict since Elasticsearch 7
+    if isinstance(total, dict):
+        total = total['value']
+    return items.all(), encode_cursor([page + 1]) if page * limit < total else None
@@ -0,0 +1,135 @@
+import json
+import random
+import re
+import time
+from collections import Counter
+
+from flask import Flask, g, has_app_context, request
+from sqlalchemy import event
+
+QUERY_COUNT_HEADER = 'X-Query-Count'
+QUERY_TIME_HEADER = 'X-Query-Time'
+N_PLUS_ONE_HEADER = 'X-Query-N-Plus-One'
+
+_WHITESPACE = re.compile(r'\s+')
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r'\bIN \((?:[^()]*)\)', re.IGNORECASE)
+
+
+def statement_shape(statement):
+    """
+    Statement without literals and with collapsed `IN` lists, equal for the queries
+    that differ only by parameters
+    """
+    shape = _WHITESPACE.sub(' ', statement).strip()
+    shape = _LITERALS.sub('?', shape)
+    return _IN_LIST.sub('IN (...)', shape)
+
+
+def query_budget(statements):
+    """
+    Max SQL statements of a GET request to the view, it must not grow with the number of rows.
+    Checked by `tests/endpoints/test_query_budgets.py`, requests over it are logged.
+    Streamed responses are not covered: their body runs its statements after the check.
+    """
+    def decorator(view):
+        view.query_budget = statements
+        return view
+    return decorator
+
+
+class QueryStats:
+    """
+    SQL statements executed while handling one request
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.
+        self.shapes = Counter()
+
+    def add(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.shapes[statement_shape(statement)] += 1
+
+    def n_plus_one(self, threshold):
+        """
+        :return: `(shape, count)` of statements repeated at least `threshold` times,
+            the most repeated first
+        """
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+
+def _current_stats():
+    return g.get('query_stats') if has_app_context() else None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    stats = _current_stats()
+    if stats is not None:
+        stats.add(statement, time.perf_counter() - started)
+
+
+def _handle_error(context):
+    # `after_cursor_execute` is not called for failed statements
+    started = context.connection.info.get('query_started') if context.connection else None
+    if started:
+        started.pop()
+
+
+def listen(engine):
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+
+
+def setup_query_stats(app: Flask, *engines):
+    """
+    Count statements and DB time of every request. They are reported in `X-Query-*` headers
+    when `QUERY_STATS_HEADERS` is on, and logged for `QUERY_STATS_SAMPLE_RATE` of requests.
+    Statements of streamed response bodies run after the report and are not counted.
+    """
+    for engine in engines:
+        listen(engine)
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = g.pop('query_stats', None)
+        if stats is None:
+            return response
+        suspects = stats.n_plus_one(app.config['N_PLUS_ONE_THRESHOLD'])
+        budget = getattr(app.view_functions.get(request.endpoint), 'query_budget', None)
+        if budget is not None and request.method == 'GET' and stats.count > budget:
+            app.logger.warning(json.dumps({
+                'event': 'query_budget_exceeded',
+                'endpoint': request.endpoint,
+                'queries': stats.count,
+                'budget': budget,
+            }))
+        if app.config['QUERY_STATS_HEADERS']:
+            response.headers[QUERY_COUNT_HEADER] = str(stats.count)
+            response.headers[QUERY_TIME_HEADER] = f'{stats.duration * 1000:.2f}'
+            response.headers[N_PLUS_ONE_HEADER] = str(sum(count for _, count in suspects))
+        if random.random() < app.config['QUERY_STATS_SAMPLE_RATE']:
+            app.logger.info(json.dumps({
+                'event': 'query_stats',
+                'endpoint': request.endpoint,
+                'method': request.method,
+                'status': response.status_code,
+                'queries': stats.count,
+                'db_time_ms': round(stats.duration * 1000, 2),
+                'n_plus_one': [
+                    {'statement': shape[:500], 'count': count} for shape, count in suspects
+                ],
+            }))
+        return response
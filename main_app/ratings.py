@@ -0,0 +1,53 @@
+from app import db
+from main_app.model import Ride, RideFeedback, User, UserFeedback
+
+# (rated model, feedback model, foreign key of the feedback), see `track_rating`
+RATED = (
+    (User, UserFeedback, 'user_id'),
+    (Ride, RideFeedback, 'ride_id'),
+)
+
+
+def _actual_totals(model, feedback_model, foreign_key):
+    """
+    :return: correlated subqueries with the sum and the number of rates of `model` rows
+    """
+    belongs = getattr(feedback_model, foreign_key) == model.id
+    rating_sum = db.select([db.func.coalesce(db.func.sum(feedback_model.rate), 0)]).\
+        where(belongs).as_scalar()
+    rating_count = db.select([db.func.count()]).where(belongs).as_scalar()
+    return rating_sum, rating_count
+
+
+def backfill_ratings():
+    """
+    Recompute all stored rating counters from the feedback tables
+
+    :return: number of updated rows per model name
+    """
+    updated = {}
+    for model, feedback_model, foreign_key in RATED:
+        rating_sum, rating_count = _actual_totals(model, feedback_model, foreign_key)
+        updated[model.__name__] = db.session.query(model).\
+            filter(db.or_(model.rating_sum != rating_sum, model.rating_count != rating_count)).\
+            update({'rating_sum': rating_sum, 'rating_count': rating_count},
+                   synchronize_session=False)
+    db.session.commit()
+    return updated
+
+
+def find_rating_mismatches():
+    """
+    :return: `(model name, id, stored (sum, count), actual (sum, count))` of every row
+        whose stored counters disagree with the feedback tables
+    """
+    mismatches = []
+    for model, feedback_model, foreign_key in RATED:
+        rating_sum, rating_count = _actual_totals(model, feedback_model, foreign_key)
+        rows = db.session.query(
+            model.id, model.rating_sum, model.rating_count, rating_sum, rating_count,
+        ).filter(db.or_(model.rating_sum != rating_sum, model.rating_count != rating_count))
+        mismatches.extend(
+            (model.__name__, row[0], (row[1], row[2]), (row[3], row[4])) for row in rows
+        )
+    return mismatches
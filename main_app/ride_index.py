@@ -0,0 +1,292 @@
+import heapq
+import math
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app
+
+from app import db
+from main_app.geo import EARTH_RADIUS_KM, bounding_box, haversine_km
+from main_app.model import Ride
+
+RideEntry = namedtuple('RideEntry', [
+    'id', 'latitude', 'longitude', 'start_datetime', 'price', 'free_seats',
+])
+
+
+def _entry(ride):
+    return RideEntry(
+        ride.id, ride.latitude, ride.longitude, ride.start_datetime, ride.price, ride.free_seats,
+    )
+
+
+class RideGridIndex:
+    """
+    In-process spatial index of active rides for `/ride/match`.
+
+    Rides are grouped by `(organization_id, from_organization)`, every group is a grid of
+    `cell_size` x `cell_size` degree cells. A group is loaded from the DB on first use and
+    reloaded when it is older than `ttl` seconds: in-between, it is kept up to date by the
+    commits of this worker (see `_collect_changes`), the reload picks up other workers' commits.
+    The index only proposes candidates, callers re-check them in the DB.
+    """
+
+    def __init__(self, cell_size, ttl):
+        self.cell_size = cell_size
+        self.ttl = ttl
+        # group -> {cell -> {ride id -> RideEntry}}
+        self._grids = {}
+        # ride id -> (group, cell)
+        self._locations = {}
+        # group -> monotonic time of the load
+        self._loaded_at = {}
+        # Changes made while groups are being loaded, `[ride id -> (group, entry or None)]`
+        # per load, they are reapplied over its possibly older rows
+        self._loading = []
+        self._lock = threading.RLock()
+
+    def _cell(self, latitude, longitude):
+        return int(math.floor(latitude / self.cell_size)), \
+            int(math.floor(longitude / self.cell_size))
+
+    def clear(self):
+        with self._lock:
+            self._grids.clear()
+            self._locations.clear()
+            self._loaded_at.clear()
+
+    def upsert(self, group, entry):
+        with self._lock:
+            for changes in self._loading:
+                changes[entry.id] = (group, entry)
+            self._discard(entry.id)
+            if group not in self._grids:
+                # Will be loaded with this ride on first use
+                return
+            cell = self._cell(entry.latitude, entry.longitude)
+            self._grids[group].setdefault(cell, {})[entry.id] = entry
+            self._locations[entry.id] = (group, cell)
+
+    def discard(self, ride_id):
+        with self._lock:
+            for changes in self._loading:
+                changes[ride_id] = (None, None)
+            self._discard(ride_id)
+
+    def _discard(self, ride_id):
+        location = self._locations.pop(ride_id, None)
+        if location is None:
+            return
+        group, cell = location
+        rides = self._grids.get(group, {}).get(cell)
+        if rides is not None:
+            rides.pop(ride_id, None)
+            if not rides:
+                del self._grids[group][cell]
+
+    def _load(self, group):
+        """
+        The DB is queried without the lock, so searches in the loaded groups are not blocked
+        """
+        organization_id, from_organization = group
+        changes = {}
+        with self._lock:
+            self._loading.append(changes)
+        try:
+            rows = db.session.query(
+                Ride.id, Ride.latitude, Ride.longitude, Ride.start_datetime, Ride.price,
+                Ride.free_seats,
+            ).filter(Ride.organization_id == organization_id).\
+                filter(Ride.from_organization == from_organization).\
+                filter(Ride.is_active).all()
+        finally:
+            with self._lock:
+                self._loading.remove(changes)
+        grid, locations = {}, {}
+        for row in rows:
+            entry = RideEntry(*row)
+            if entry.id in changes:
+                continue
+            cell = self._cell(entry.latitude, entry.longitude)
+            grid.setdefault(cell, {})[entry.id] = entry
+            locations[entry.id] = (group, cell)
+        with self._lock:
+            for ride_id, (old_group, _) in list(self._locations.items()):
+                if old_group == group and ride_id not in changes:
+                    self._discard(ride_id)
+            for ride_id, (changed_group, entry) in changes.items():
+                if changed_group == group:
+                    self._discard(ride_id)
+                    cell = self._cell(entry.latitude, entry.longitude)
+                    grid.setdefault(cell, {})[ride_id] = entry
+                    locations[ride_id] = (group, cell)
+            self._grids[group] = grid
+            self._locations.update(locations)
+            self._loaded_at[group] = time.monotonic()
+
+    def warm(self):
+        """
+        Load every group with active rides
+        """
+        groups = db.session.query(Ride.organization_id, Ride.from_organization).\
+            filter(Ride.is_active).distinct().all()
+        for group in groups:
+            self._load(tuple(group))
+
+    def _refresh(self, group):
+        loaded_at = self._loaded_at.get(group)
+        if loaded_at is None or time.monotonic() - loaded_at > self.ttl:
+            self._load(group)
+
+    def within(self, group, latitude, longitude, radius_km, predicate=None):
+        """
+        :return: `(distance, RideEntry)` pairs within `radius_km`, nearest first
+        """
+        min_latitude, max_latitude, min_longitude, max_longitude = bounding_box(
+            latitude, longitude, radius_km)
+        min_row, min_column = self._cell(min_latitude, min_longitude)
+        max_row, max_column = self._cell(max_latitude, max_longitude)
+        result = []
+        self._refresh(group)
+        with self._lock:
+            grid = self._grids.get(group, {})
+            # Cells of the box are looked up, unless the whole grid is smaller than the box
+            if (max_row - min_row + 1) * (max_column - min_column + 1) <= len(grid):
+                cells = (
+                    grid.get((row, column)) for row in range(min_row, max_row + 1)
+                    for column in range(min_column, max_column + 1)
+                )
+            else:
+                cells = (
+                    rides for (row, column), rides in grid.items()
+                    if min_row <= row <= max_row and min_column <= column <= max_column
+                )
+            for rides in cells:
+                if not rides:
+                    continue
+                for entry in rides.values():
+                    distance = haversine_km(latitude, longitude, entry.latitude, entry.longitude)
+                    if distance <= radius_km and (predicate is None or predicate(entry)):
+                        result.append((distance, entry))
+        result.sort(key=lambda x: (x[0], x[1].id))
+        return result
+
+    def nearest(self, group, latitude, longitude, k, max_distance_km=None, predicate=None,
+                after=None):
+        """
+        k nearest rides, searched ring by ring of cells around the point
+
+        :param after: `(distance, id)` of the last ride of the previous page
+
+        :return: `(distance, RideEntry)` pairs, nearest first
+        """
+        center_row, center_column = self._cell(latitude, longitude)
+        best = []
+        self._refresh(group)
+        with self._lock:
+            grid = self._grids.get(group)
+            if not grid:
+                return []
+            max_ring = max(
+                max(abs(row - center_row), abs(column - center_column)) for row, column in grid
+            )
+            for ring in range(max_ring + 1):
+                ring_km = self._ring_km(latitude, ring)
+                if len(best) == k and -best[0][0] < ring_km:
+                    break
+                if max_distance_km is not None and ring_km > max_distance_km:
+                    break
+                for cell in self._ring_cells(center_row, center_column, ring):
+                    for entry in grid.get(cell, {}).values():
+                        distance = haversine_km(
+                            latitude, longitude, entry.latitude, entry.longitude)
+                        if max_distance_km is not None and distance > max_distance_km:
+                            continue
+                        if after is not None and (distance, entry.id) <= tuple(after):
+                            continue
+                        if predicate is not None and not predicate(entry):
+                            continue
+                        # Max-heap on (distance, id) keeps the k best
+                        item = (-distance, -entry.id, entry)
+                        if len(best) < k:
+                            heapq.heappush(best, item)
+                        elif item > best[0]:
+                            heapq.heapreplace(best, item)
+        return [(-distance, entry) for distance, _, entry in sorted(best, reverse=True)]
+
+    def _ring_km(self, latitude, ring):
+        """
+        Lower bound of the distance from a point to the cells of `ring` around its cell:
+        they are at least `ring - 1` cells away along a parallel or a meridian
+        """
+        if ring <= 1:
+            return 0.
+        offset = math.radians((ring - 1) * self.cell_size)
+        along_meridian = EARTH_RADIUS_KM * offset
+        # Distance to the meridian `offset` away
+        along_parallel = EARTH_RADIUS_KM * math.asin(
+            math.cos(math.radians(latitude)) * math.sin(min(offset, math.pi / 2)))
+        return min(along_meridian, along_parallel)
+
+    @staticmethod
+    def _ring_cells(center_row, center_column, ring):
+        if ring == 0:
+            yield center_row, center_column
+            return
+        for column in range(center_column - ring, center_column + ring + 1):
+            yield center_row - ring, column
+            yield center_row + ring, column
+        for row in range(center_row - ring + 1, center_row + ring):
+            yield row, center_column - ring
+            yield row, center_column + ring
+
+
+def _collect_changes(session, flush_context):
+    """
+    Snapshot rides changed by the flush, they are applied to the index only after commit
+    """
+    changes = session.info.setdefault('ride_index_changes', {})
+    for ride in session.deleted:
+        if isinstance(ride, Ride):
+            changes[ride.id] = None
+    for ride in list(session.new) + list(session.dirty):
+        if isinstance(ride, Ride):
+            changes[ride.id] = \
+                ((ride.organization_id, ride.from_organization), _entry(ride)) \
+                if ride.is_active else None
+
+
+def refresh_rides(ride_ids):
+    """
+    Snapshot rides changed by a bulk UPDATE, it bypasses the session and so `_collect_changes`
+    """
+    if not current_app.config['RIDE_INDEX_ENABLED']:
+        return
+    changes = db.session.info.setdefault('ride_index_changes', {})
+    for ride_id, organization_id, from_organization, is_active, *values in db.session.query(
+        Ride.id, Ride.organization_id, Ride.from_organization, Ride.is_active,
+        Ride.latitude, Ride.longitude, Ride.start_datetime, Ride.price, Ride.free_seats,
+    ).filter(Ride.id.in_(ride_ids)):
+        changes[ride_id] = ((organization_id, from_organization), RideEntry(ride_id, *values)) \
+            if is_active else None
+
+
+def _apply_changes(session):
+    changes = session.info.pop('ride_index_changes', None)
+    if not changes or not current_app.config['RIDE_INDEX_ENABLED']:
+        return
+    for ride_id, change in changes.items():
+        if change is None:
+            current_app.ride_index.discard(ride_id)
+        else:
+            current_app.ride_index.upsert(*change)
+
+
+def _drop_changes(session):
+    session.info.pop('ride_index_changes', None)
+
+
+db.event.listen(db.session, 'after_flush', _collect_changes)
+db.event.listen(db.session, 'after_commit', _apply_changes)
+db.event.listen(db.session, 'after_rollback', _drop_changes)
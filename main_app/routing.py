@@ -0,0 +1,41 @@
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.selectable import SelectBase
+
+REPLICA_BIND = 'replica'
+READ_METHODS = ('GET', 'HEAD')
+
+
+class RoutingSession(SignallingSession):
+    """
+    Sends SELECTs of GET requests to the `replica` bind when it is configured.
+
+    Flushes and INSERT/UPDATE/DELETE statements go to the primary, and so does everything
+    after them in the session: it lives for one request, which then reads its own writes.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def _use_replica(self, clause):
+        if REPLICA_BIND not in (self.app.config['SQLALCHEMY_BINDS'] or {}):
+            return False
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['primary_only'] = True
+            return False
+        return isinstance(clause, SelectBase) and not self.info.get('primary_only') and \
+            has_request_context() and request.method in READ_METHODS
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._use_replica(clause):
+            return self.db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause, **kwargs)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -1,12 +1,21 @@
-from marshmallow import fields, validates, ValidationError, Schema, post_load
-from marshmallow.validate import Length
-from flask import jsonify
+from datetime import datetime
+
+from marshmallow import fields, validates, ValidationError, Schema, post_load, pre_dump
+from marshmallow.validate import Length, Range
+from flask import jsonify, current_app
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, selectinload
+from werkzeug.exceptions import HTTPException
 
 from app import ma, db
-from main_app.model import Ride, User, Organization, Car, JoinRideRequest, RideFeedback
-from settings import MAX_EMAIL_LENGTH
+from main_app.model import Ride, User, Organization, Car, JoinRideRequest, RideFeedback, \
+    current_user_join_requests
+from settings import MAX_EMAIL_LENGTH, MATCH_MAX_DISTANCE_KM, MATCH_TIME_WINDOW_MINUTES, \
+    MAX_MATCHED_RIDES, MAX_PAGE_SIZE
 from main_app.controller import check_email, parse_phone_number, check_image_url
 from main_app.responses import SwaggerResponses
+from main_app.misc import reverse_geocoding_batch
+from main_app.pagination import decode_cursor
 
 STANDART_RIDE_INFO = [
     'id', 'free_seats',
@@ -30,6 +39,53 @@ class CamelCaseSchema(Schema):
         field_obj.data_key = camelcase(field_obj.data_key or field_name)
 
 
+class EagerLoadSchema(Schema):
+    """
+    Schema that knows which relationships its fields walk through.
+
+    `__eager_load__` maps a field name to relationship paths of the schema model,
+    e.g. `{'passengers': ['passengers', 'passengers.cars']}`. `eager_load_options()` turns the paths
+    of the fields being dumped (`only=`) into loader options, so that a list of objects
+    is dumped with a constant number of queries.
+    """
+    __eager_load__ = {}
+
+    def eager_load_options(self):
+        paths = set()
+        for name in self.fields:
+            paths.update(self.__eager_load__.get(name, ()))
+        options = []
+        for path in sorted(paths):
+            option, mapper = None, inspect(self.opts.model)
+            for name in path.split('.'):
+                relationship = mapper.relationships[name]
+                attribute = getattr(mapper.class_, name)
+                # Collections are loaded by a second `IN` query, single objects are joined
+                loader = selectinload if relationship.uselist else joinedload
+                option = loader(attribute) if option is None \
+                    else getattr(option, loader.__name__)(attribute)
+                mapper = relationship.mapper
+            options.append(option)
+        return options
+
+
+class CursorField(fields.String):
+    """
+    Opaque pagination cursor, loaded as the list of sort key values.
+    Their number is checked here when `length` is given, otherwise by `paginate`.
+    """
+
+    def __init__(self, length=None, **kwargs):
+        super().__init__(**kwargs)
+        self.length = length
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        values = decode_cursor(super()._deserialize(value, attr, data, **kwargs))
+        if not isinstance(values, list) or self.length is not None and len(values) != self.length:
+            raise ValidationError('Invalid cursor')
+        return values
+
+
 class LoginSchema(Schema):
     login = fields.Email(required=True, validate=Length(max=MAX_EMAIL_LENGTH))
     password = fields.String(required=True)
@@ -86,18 +142,52 @@ class JoinRideJsonSchema(ma.ModelSchema, CamelCaseSchema):
     ))
 
 
+class JoinRequestAnswerSchema(CamelCaseSchema):
+    ride_id = fields.Integer(required=True)
+    # Only for declines
+    decline_reason = fields.String(missing=None, validate=Length(max=200))
+
+
+class JoinRequestDecisionSchema(JoinRequestAnswerSchema):
+    """
+    Answer of the host to the join request of `user_id` to the ride
+    """
+    user_id = fields.Integer(required=True)
+
+
+class JoinRequestsDecisionSchema(JoinRequestAnswerSchema):
+    """
+    Same answer to the join requests of all `user_ids` to the ride
+    """
+    user_ids = fields.List(
+        fields.Integer(), required=True, validate=Length(min=1, max=MAX_PAGE_SIZE))
+
+
 class RideSchema(ma.ModelSchema):
     class Meta:
         model = Ride
         include_fk = True
+        exclude = ['occupied_seats', *Ride.__rating_counters__]
     is_mine = fields.Boolean(required=True)
 
 
-class RideJsonSchema(ma.ModelSchema, CamelCaseSchema):
+class RideJsonSchema(ma.ModelSchema, CamelCaseSchema, EagerLoadSchema):
     class Meta:
         model = Ride
         sqla_session = db.session
-    address = fields.String(dump_only=True)
+        # `occupied_seats` is bookkeeping of `reserve_seats`, clients get `free_seats`
+        exclude = ['occupied_seats', *Ride.__rating_counters__]
+    __eager_load__ = {
+        'host': ['host'],
+        'is_mine': ['host'],
+        'car': ['car'],
+        'organization': ['organization'],
+        'organization_address': ['organization'],
+        'organization_name': ['organization'],
+        'passengers': ['passengers'],
+        'join_requests': ['join_requests', 'join_requests.user'],
+    }
+    address = fields.Method('get_address', dump_only=True)
     free_seats = fields.Integer(dump_only=True)
     car = fields.Nested('CarSchema')
     car_id = fields.Integer(required=True, load_only=True)
@@ -111,8 +201,8 @@ class RideJsonSchema(ma.ModelSchema, CamelCaseSchema):
     host = fields.Nested('UserJsonSchema', only=(
         'id', 'first_name', 'last_name', 'photo_url', 'rating', 'phone_number'
     ))
-    host_answer = fields.String(dump_only=True)
-    decline_reason = fields.String(dump_only=True)
+    host_answer = fields.Method('get_host_answer', dump_only=True)
+    decline_reason = fields.Method('get_decline_reason', dump_only=True)
     passengers = fields.Nested('UserJsonSchema', many=True, only=(
         'id', 'first_name', 'last_name', 'photo_url', 'rating',
     ))
@@ -124,18 +214,71 @@ class RideJsonSchema(ma.ModelSchema, CamelCaseSchema):
         'ride_id', 'user', 'status', 'decline_reason'
     ))
 
+    @pre_dump(pass_many=True)
+    def prefetch_addresses(self, data, many, **kwargs):
+        """
+        Rides created before `ride.address` was stored get their addresses
+        in one batch instead of one geocoder call per ride.
+        They are only dumped, the rides are left unchanged.
+        """
+        self.context['ride_addresses'] = {}
+        if 'address' not in self.fields:
+            return data
+        rides = list(data) if many else [data]
+        missing = [ride for ride in rides if ride is not None and ride.address is None]
+        if missing:
+            try:
+                results = reverse_geocoding_batch(
+                    [(ride.latitude, ride.longitude) for ride in missing])
+            except HTTPException as e:
+                current_app.logger.warning(f'Could not resolve ride addresses: {e}')
+            else:
+                self.context['ride_addresses'] = {
+                    ride.id: result['address'] for ride, result in zip(missing, results)
+                }
+        return rides if many else data
+
+    def get_address(self, ride):
+        if ride.address is not None:
+            return ride.address
+        return self.context.get('ride_addresses', {}).get(ride.id)
+
+    @pre_dump(pass_many=True)
+    def prefetch_join_requests(self, data, many, **kwargs):
+        """
+        `host_answer` and `decline_reason` of all rides with one query.
+        The requests are kept for this dump only, they may be decided later in the request.
+        """
+        self.context['join_requests'] = {}
+        if 'host_answer' not in self.fields and 'decline_reason' not in self.fields:
+            return data
+        rides = list(data) if many else [data]
+        self.context['join_requests'] = current_user_join_requests(
+            [ride for ride in rides if ride is not None])
+        return rides if many else data
+
+    def get_host_answer(self, ride):
+        request = self.context.get('join_requests', {}).get(ride.id)
+        if request is not None:
+            return request.host_answer
+
+    def get_decline_reason(self, ride):
+        request = self.context.get('join_requests', {}).get(ride.id)
+        if request is not None:
+            return request.decline_reason or ''
+
 
 class OrganizationSchemaUserIDs(ma.ModelSchema):
     class Meta:
         model = Organization
-        exclude = ['rides']
+        exclude = ['rides', *Organization.__stats__]
 
 
 class UserSchemaOrganizationInfo(ma.ModelSchema):
     class Meta:
         model = User
         include_fk = True
-        exclude = ['_password_hash', 'all_rides']
+        exclude = ['_password_hash', 'all_rides', *User.__rating_counters__]
     is_driver = fields.Boolean()
     organizations = fields.Nested(OrganizationSchemaUserIDs, many=True)
 
@@ -144,10 +287,35 @@ class IdSchema(CamelCaseSchema):
     id = fields.Integer(required=True)
 
 
+class PageSchema(CamelCaseSchema):
+    """
+    Query args of paginated lists, see `main_app.pagination.paginate`
+    """
+    # `None` means the default page size of the endpoint
+    limit = fields.Integer(missing=None, validate=Range(min=1, max=MAX_PAGE_SIZE))
+    cursor = CursorField(missing=None)
+
+
+class OrganizationListSchema(PageSchema):
+    # Whole list in one chunked response, `limit` and `cursor` are ignored
+    stream = fields.Boolean(missing=False)
+
+
+class IdPageSchema(IdSchema, PageSchema):
+    """
+    Query args of lists nested in the object with `id`
+    """
+
+
+class SearchSchema(PageSchema):
+    query = fields.String(required=True)
+
+
 class UserJsonSchema(ma.ModelSchema, CamelCaseSchema):
     class Meta:
         model = User
         sqla_session = db.session
+        exclude = User.__rating_counters__
     organizations = fields.Nested('OrganizationJsonSchema', many=True)
     rating = fields.Float(dump_only=True)
 
@@ -169,6 +337,7 @@ class OrganizationJsonSchema(ma.ModelSchema, CamelCaseSchema):
     class Meta:
         model = Organization
         sqla_session = db.session
+        exclude = Organization.__stats__
     last_ride_datetime = fields.String(dump_only=True)
     users = fields.Nested(UserJsonSchema, only=(
         'id', 'first_name', 'last_name', 'photo_url', 'rating'
@@ -195,6 +364,7 @@ class OrganizationPermissiveSchema(OrganizationJsonSchema):
         model = Organization
         sqla_session = db.session
         only = ('id', 'name', 'latitude', 'longitude')
+        exclude = Organization.__stats__
 
     def on_bind_field(self, field_name, field_obj):
         super().on_bind_field(field_name, field_obj)
@@ -207,14 +377,23 @@ class UserSchemaOrganizationIDs(ma.ModelSchema):
     class Meta:
         model = User
         include_fk = True
-        exclude = ['_password_hash', 'all_rides']
+        exclude = ['_password_hash', 'all_rides', *User.__rating_counters__]
     is_driver = fields.Boolean()
 
 
-class OrganizationSchemaUserInfo(ma.ModelSchema):
+class OrganizationSchemaUserInfo(ma.ModelSchema, EagerLoadSchema):
+    __eager_load__ = {
+        'creator': ['creator'],
+        # Every relationship of a member is dumped as the list of ids
+        'users': ['users'] + [f'users.{name}' for name in (
+            'join_requests', 'organizations', 'hosted_rides', 'cars', 'reviews',
+            'userfeedback_left', 'ridefeedback_left', 'firebase_id',
+        )],
+    }
+
     class Meta:
         model = Organization
-        exclude = ['rides']
+        exclude = ['rides', *Organization.__stats__]
     users = fields.Nested(UserSchemaOrganizationIDs, many=True)
 
 
@@ -241,7 +420,7 @@ class UserSchemaNoOrganizations(ma.ModelSchema):
     class Meta:
         model = User
         include_fk = True
-        exclude = ['_password_hash', 'all_rides']
+        exclude = ['_password_hash', 'all_rides', *User.__rating_counters__]
 
 
 class UserIDSchema(Schema):
@@ -251,7 +430,7 @@ class UserIDSchema(Schema):
 class RegisterUserSchema(ma.ModelSchema, CamelCaseSchema):
     class Meta:
         model = User
-        exclude = ['_password_hash', 'id', ]
+        exclude = ['_password_hash', 'id', *User.__rating_counters__]
     email = fields.Email(required=True)
     password = fields.String(required=True)
     phone_number = fields.String(required=True)
@@ -343,6 +522,28 @@ class RideSearchSchema(CamelCaseSchema):
     latitude = fields.Float(required=True)
     longitude = fields.Float(required=True)
     from_organization = fields.Boolean(required=True)
+    # Only rides within `max_distance` km that start within `time_window` minutes
+    # of `start_datetime` are matched
+    max_distance = fields.Float(missing=MATCH_MAX_DISTANCE_KM, validate=Range(min=0))
+    start_datetime = fields.DateTime(missing=datetime.now)
+    time_window = fields.Integer(missing=MATCH_TIME_WINDOW_MINUTES, validate=Range(min=0))
+    limit = fields.Integer(missing=MAX_MATCHED_RIDES, validate=Range(min=1, max=MAX_PAGE_SIZE))
+    # (score, ride id) of the last ride on the previous page and `start_datetime` it was
+    # scored for, the next pages are scored for the same time
+    cursor = CursorField(length=3, missing=None)
+
+    @post_load
+    def normalize_start_datetime(self, data, **kwargs):
+        if data['cursor'] is not None:
+            score, ride_id, start_datetime = data['cursor']
+            if not isinstance(score, (int, float)) or not isinstance(ride_id, int) or \
+                    not isinstance(start_datetime, datetime):
+                raise ValidationError('Invalid cursor')
+            data['start_datetime'] = start_datetime
+        # Ride times are naive local time, like the `datetime.now` default above
+        if data['start_datetime'].tzinfo is not None:
+            data['start_datetime'] = data['start_datetime'].astimezone().replace(tzinfo=None)
+        return data
 
 
 class ReverseGeocodingSchema(Schema):
@@ -365,10 +566,6 @@ class RideFeedbackSchema(ma.ModelSchema, CamelCaseSchema):
     ride = fields.Nested(RideJsonSchema, only=('id', ), required=True)
 
 
-class SearchSchema(CamelCaseSchema):
-    query = fields.String(required=True)
-
-
 class PasswordChangeSchema(CamelCaseSchema):
     old_password = fields.String(required=True)
     new_password = fields.String(required=True)
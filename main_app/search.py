@@ -1,5 +1,17 @@
+from elasticsearch.exceptions import ConnectionError as ElasticConnectionError
 from flask import current_app
 
+from main_app.exceptions.custom import DependencyUnavailable
+
+
+def _guarded(func):
+    """
+    Run an Elasticsearch call through its rate limiter and circuit breaker.
+    Only connection problems count as failures, e.g. 404 on delete does not.
+    """
+    return current_app.outbound.guard('elasticsearch').call(
+        func, failure_exceptions=(ElasticConnectionError, ))
+
 
 def add_to_index(index, model):
     if not current_app.elasticsearch:
@@ -7,22 +19,34 @@ def add_to_index(index, model):
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, doc_type=index, id=model.id,
-                                    body=payload)
+    try:
+        _guarded(lambda: current_app.elasticsearch.index(
+            index=index, doc_type=index, id=model.id, body=payload))
+    except (DependencyUnavailable, ElasticConnectionError) as e:
+        # The row is already committed, it will be indexed by the next `reindex`
+        current_app.logger.warning(f'Could not index {index} {model.id}: {e}')
 
 
 def remove_from_index(index, model):
     if not current_app.elasticsearch:
         return
-    current_app.elasticsearch.delete(index=index, doc_type=index, id=model.id)
+    try:
+        _guarded(lambda: current_app.elasticsearch.delete(index=index, doc_type=index, id=model.id))
+    except (DependencyUnavailable, ElasticConnectionError) as e:
+        current_app.logger.warning(f'Could not remove {index} {model.id} from index: {e}')
 
 
 def query_index(index, query, page, per_page):
     if not current_app.elasticsearch:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index, doc_type=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
+    try:
+        search = _guarded(lambda: current_app.elasticsearch.search(
+            index=index, doc_type=index,
+            body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                  'from': (page - 1) * per_page, 'size': per_page}))
+    except (DependencyUnavailable, ElasticConnectionError) as e:
+        # Degraded answer: nothing found
+        current_app.logger.warning(f'Search in {index} failed: {e}')
+        return [], 0
     ids = [int(hit['_id']) for hit in search['hits']['hits']]
     return ids, search['hits']['total']
@@ -1,20 +1,25 @@
 from flask import jsonify, request
 from flask_login import login_required, current_user
 
-from main_app.schemas import CarSchema, CarPermissiveSchema, RegisterCarForDriverSchema, IdSchema
+from main_app.schemas import CarSchema, CarPermissiveSchema, RegisterCarForDriverSchema, IdSchema, \
+    PageSchema
 from app import db
-from main_app.model import Car, User
+from settings import MAX_PAGE_SIZE
+from main_app.model import Car
 from main_app.exceptions.custom import InsufficientPermissions
 from main_app.controller import validate_params_with_schema
+from main_app.pagination import paginate, with_next_cursor
 from main_app.views import api
+from main_app.query_stats import query_budget
 
 
 @api.route('/car', methods=['GET', 'POST', 'PUT', 'DELETE'])
 @login_required
+@query_budget(2)
 def car():
     if request.method == 'GET':
         # Only own cars
-        return jsonify(CarSchema(many=True).dump(current_user.cars))
+        return own_cars()
     if request.method == 'POST':
         car = CarPermissiveSchema().load(request.json)
         # If not found in DB, abort
@@ -42,10 +47,17 @@ def car():
 
 @api.route('/get_my_cars', methods=['GET'])
 @login_required
+@query_budget(2)
 def get_my_cars():
-    car_schema = CarSchema(many=True)
-    corresponding_driver = db.session.query(User).filter_by(id=current_user.id).first()
-    return jsonify(car_schema.dump(corresponding_driver.cars))
+    return own_cars()
+
+
+def own_cars():
+    page = PageSchema().load(request.args)
+    cars, next_cursor = paginate(
+        db.session.query(Car).filter(Car.owner_id == current_user.id),
+        [Car.id], page['cursor'], page['limit'] or MAX_PAGE_SIZE)
+    return with_next_cursor(jsonify(CarSchema(many=True).dump(cars)), next_cursor)
 
 
 def register_car(car_info):
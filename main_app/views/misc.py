@@ -2,7 +2,7 @@ from main_app.misc import get_distance, reverse_geocoding_blocking, forward_geoc
 from main_app.views import api
 from main_app.schemas import ReverseGeocodingSchema, \
     ForwardGeocodingSchema, OrganizationSchemaUserIDs
-from flask import request, jsonify
+from flask import request, jsonify, current_app
 from flask_login import login_required, current_user
 
 
@@ -12,6 +12,17 @@ def decode_gps():
     return jsonify(reverse_geocoding_blocking(**data))
 
 
+@api.route('/geocoding/stats', methods=['GET'])
+@login_required
+def geocoding_stats():
+    # NOTE: counters are per worker process
+    return jsonify(
+        reverse=current_app.reverse_geocoding_cache.stats(),
+        forward=current_app.forward_geocoding_cache.stats(),
+        outbound=current_app.outbound.stats(),
+    )
+
+
 @api.route('/encode_address', methods=['POST'])
 def encode_address():
     data = ForwardGeocodingSchema().load(request.json)
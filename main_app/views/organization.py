@@ -1,31 +1,36 @@
 from flask import request, jsonify
 from flask_login import login_required, current_user
+from sqlalchemy.orm import undefer_group
 
 from app import db
-from main_app.model import Organization
+from main_app.model import Organization, User
 from main_app.schemas import OrganizationSchemaUserInfo,\
     IdSchema, OrganizationJsonSchema, JoinOrganizationSchema, OrganizationPermissiveSchema,\
-    SearchSchema
+    SearchSchema, OrganizationListSchema, IdPageSchema
 from main_app.exceptions.custom import IncorrectControlAnswer, \
     NotInOrganization, CreatorCannotLeave, InsufficientPermissions
 from main_app.views import api
+from main_app.query_stats import query_budget
 from main_app.misc import reverse_geocoding_blocking
+from main_app.pagination import paginate, paginate_search, stream_json_array, with_next_cursor
+from settings import MAX_PAGE_SIZE, SEARCH_PAGE_SIZE, STREAM_CHUNK_SIZE
 
 
 @api.route('/organization', methods=['GET', 'POST', 'PUT'])
 @login_required
+@query_budget(4)
 def organization():
     if request.method == 'GET':
         return OrganizationJsonSchema(exclude=('users', 'rides', 'control_question')).dump(
             db.session.query(Organization).filter_by(
                 **IdSchema().load(request.args)
-            ).first()
+            ).options(undefer_group('stats')).first()
         )
     if request.method == 'PUT':
         org = OrganizationJsonSchema().load(request.json)
         org.creator = current_user
         org.address = reverse_geocoding_blocking(
-            latitude=org.latitude, longitude=org.longitude
+            latitude=org.latitude, longitude=org.longitude, degrade=False
         )['address']
         org.users = [current_user]
         db.session.add(org)
@@ -40,7 +45,7 @@ def organization():
         # Update address
         # NOTE: maybe move it to DB hooks?
         org.address = reverse_geocoding_blocking(
-            latitude=org.latitude, longitude=org.longitude
+            latitude=org.latitude, longitude=org.longitude, degrade=False
         )['address']
         db.session.add(org)
         db.session.commit()
@@ -49,14 +54,23 @@ def organization():
 
 @api.route('/organization/members', methods=['GET'])
 @login_required
+@query_budget(4)
 def organization_members():
-    return OrganizationJsonSchema(only=('id', 'users')).dump(
-        db.session.query(Organization).filter_by(**IdSchema().load(request.args)).first()
-    )
+    page = IdPageSchema().load(request.args)
+    org = db.session.query(Organization).filter_by(id=page['id']).first()
+    if org is None:
+        return OrganizationJsonSchema(only=('id', 'users')).dump(None)
+    users, next_cursor = paginate(
+        db.session.query(User).with_parent(org, 'users'),
+        [User.id], page['cursor'], page['limit'] or MAX_PAGE_SIZE)
+    return with_next_cursor(jsonify(
+        OrganizationJsonSchema(only=('id', 'users')).dump({'id': org.id, 'users': users})
+    ), next_cursor)
 
 
 @api.route('/organization/question', methods=['GET'])
 @login_required
+@query_budget(2)
 def question():
     return OrganizationJsonSchema(only=('id', 'control_question')).dump(
         db.session.query(Organization).filter_by(**IdSchema().load(request.args)).first()
@@ -91,17 +105,30 @@ def leave():
 
 @api.route('/get_all_organizations', methods=['GET'])
 @login_required
+# Paginated responses only, `stream` takes a few statements per `STREAM_CHUNK_SIZE` rows
+@query_budget(12)
 def get_all_organizations():
+    page = OrganizationListSchema().load(request.args)
     organization_schema = OrganizationSchemaUserInfo(many=True)
-    result = organization_schema.dump(db.session.query(Organization).all(), many=True)
-    return jsonify(result), 200
+    query = db.session.query(Organization).options(*organization_schema.eager_load_options())
+    if page['stream']:
+        # Server-side cursor, the users are loaded for every chunk of organizations
+        return stream_json_array(
+            query.order_by(Organization.id).yield_per(STREAM_CHUNK_SIZE),
+            OrganizationSchemaUserInfo())
+    organizations, next_cursor = paginate(
+        query, [Organization.id], page['cursor'], page['limit'] or MAX_PAGE_SIZE)
+    result = organization_schema.dump(organizations, many=True)
+    return with_next_cursor(jsonify(result), next_cursor), 200
 
 
 @api.route('/organization/search', methods=['GET'])
 @login_required
 def search_organizations():
     query_string = SearchSchema().load(request.args)
-    results, total = Organization.search(query_string['query'], 1, 10)
-    return jsonify(OrganizationJsonSchema(many=True, only=(
+    results, next_cursor = paginate_search(
+        Organization, query_string['query'], query_string['cursor'],
+        query_string['limit'] or SEARCH_PAGE_SIZE)
+    return with_next_cursor(jsonify(OrganizationJsonSchema(many=True, only=(
         'id', 'name', 'address'
-    )).dump(results))
+    )).dump(results)), next_cursor)
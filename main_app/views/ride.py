@@ -1,38 +1,85 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import List
 
-from flask import jsonify, request
+from flask import current_app, jsonify, request
 from flask_login import login_required, current_user
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
 from app import db
-from main_app.model import Ride, Organization, JoinRideRequest, RideFeedback
+from settings import MATCH_MAX_CANDIDATES, MAX_PAGE_SIZE
+from main_app.model import Ride, Organization, JoinRideRequest, RideFeedback, User, \
+    association_user_ride
 from main_app.schemas import \
     RideJsonSchema, IdSchema, UserJsonSchema, \
-    JoinRideJsonSchema, RideSearchSchema, RideFeedbackSchema, STANDART_RIDE_INFO
+    JoinRideJsonSchema, RideSearchSchema, RideFeedbackSchema, PageSchema, IdPageSchema, \
+    JoinRequestDecisionSchema, JoinRequestsDecisionSchema, STANDART_RIDE_INFO
 from main_app.views import api
+from main_app.query_stats import query_budget
 from main_app.exceptions.custom import NotInOrganization, NotCarOwner, \
     RideNotActive, NoFreeSeats, CreatorCannotJoin, RequestAlreadySent, InsufficientPermissions, \
-    NotInRide, NotForOwner, RideNotFinished, AlreadyDecided
-from main_app.misc import get_distance
+    NotInRide, NotForOwner, RideNotFinished, AlreadyDecided, DependencyUnavailable
+from main_app.misc import reverse_geocoding_blocking
+from main_app.geo import bounding_box
+from main_app.matching import MatchingEngine, candidates_from_rows
+from main_app.pagination import encode_cursor, paginate, with_next_cursor
+from main_app.ride_index import refresh_rides
 
 MAX_RIDES_IN_HISTORY = 10
 
 
 @api.route('/ride/active', methods=['GET'])
 @login_required
+@query_budget(5)
 def active_rides():
-    # TODO: move logic to SQL-query, not pythonic `filter`
-    requests_to_active_rides = filter(
-        lambda request: request.ride.is_active,
-        current_user.join_requests)
-    return jsonify(RideJsonSchema(only=(
+    page = PageSchema().load(request.args)
+    schema = RideJsonSchema(only=(
         STANDART_RIDE_INFO + ['host_answer', 'organization_address']
-    ), many=True).dump([request.ride for request in requests_to_active_rides]))
+    ), many=True)
+    query = db.session.query(Ride).join(Ride.join_requests).\
+        filter(JoinRideRequest.user_id == current_user.id).\
+        filter(Ride.is_active).\
+        options(*schema.eager_load_options())
+    rides, next_cursor = paginate(
+        query, [Ride.start_datetime, Ride.id], page['cursor'], page['limit'] or MAX_PAGE_SIZE)
+    return with_next_cursor(jsonify(schema.dump(rides)), next_cursor)
+
+
+def _query_candidates(org, data):
+    latitude, longitude = data['latitude'], data['longitude']
+    min_latitude, max_latitude, min_longitude, max_longitude = bounding_box(
+        latitude, longitude, data['max_distance'])
+    time_window = timedelta(minutes=data['time_window'])
+    rows = db.session.query(
+        Ride.id, Ride.latitude, Ride.longitude, Ride.start_datetime, Ride.price, Ride.free_seats,
+    ).filter(Ride.organization_id == org.id).\
+        filter(Ride.from_organization == data['from_organization']).\
+        filter(Ride.is_active).\
+        filter(Ride.latitude.between(min_latitude, max_latitude)).\
+        filter(Ride.longitude.between(min_longitude, max_longitude)).\
+        filter(Ride.start_datetime.between(
+            data['start_datetime'] - time_window, data['start_datetime'] + time_window)).\
+        filter(Ride.distance_to(latitude, longitude) <= data['max_distance']).\
+        order_by(Ride.distance_to(latitude, longitude), Ride.id).\
+        limit(MATCH_MAX_CANDIDATES).all()
+    return candidates_from_rows(rows)
+
+
+def _index_candidates(org, data):
+    time_window = timedelta(minutes=data['time_window'])
+    earliest = data['start_datetime'] - time_window
+    latest = data['start_datetime'] + time_window
+    matches = current_app.ride_index.within(
+        (org.id, data['from_organization']),
+        data['latitude'], data['longitude'], data['max_distance'],
+        predicate=lambda entry: earliest <= entry.start_datetime <= latest,
+    )
+    return candidates_from_rows(entry for _, entry in matches[:MATCH_MAX_CANDIDATES])
 
 
 @api.route('/ride/match', methods=['GET'])
 @login_required
+@query_budget(8)
 def match_ride():
     data = RideSearchSchema().load(request.args)
     org = db.session.query(Organization).filter_by(id=data['id']).first()
@@ -40,27 +87,38 @@ def match_ride():
         raise InsufficientPermissions()
     if org not in current_user.organizations:
         raise NotInOrganization()
-    latitude, longitude = data['latitude'], data['longitude']
-    from_organization = data['from_organization']
-
-    # match ride
-    all_rides = db.session.query(Ride).\
-        filter(Ride.organization_id == org.id).\
-        filter(Ride.from_organization == from_organization).\
-        filter(Ride.is_active).all()
-    ranged_rides = sorted(
-        all_rides,
-        key=lambda ride: get_distance(
-            (ride.latitude, ride.longitude),
-            (latitude, longitude))
+    # The DB only prefilters candidates, the score is computed by the matching engine.
+    # Only `MATCH_MAX_CANDIDATES` rides nearest to the pickup point are ranked, on every page.
+    if current_app.config['RIDE_INDEX_ENABLED']:
+        candidates = _index_candidates(org, data)
+    else:
+        candidates = _query_candidates(org, data)
+    ranked = MatchingEngine.from_config(current_app.config).top_k(
+        candidates, data['latitude'], data['longitude'], data['start_datetime'],
+        # One extra ride tells whether there is a next page
+        k=data['limit'] + 1, after=data['cursor'] and data['cursor'][:2],
     )
-    return jsonify(RideJsonSchema(only=(
+    page = ranked[:data['limit']]
+    # The start time goes into the cursor as the scores of the next pages depend on it
+    next_cursor = encode_cursor([*page[-1], data['start_datetime']]) \
+        if len(ranked) > data['limit'] else None
+    ids = [ride_id for _, ride_id in page]
+    schema = RideJsonSchema(only=(
         'id', 'car', 'submit_datetime', 'start_datetime',
         'price', 'host', 'free_seats',
         'passengers',
         'organization_address', 'host_answer',
         'latitude', 'longitude', 'address',
-    ), many=True).dump(ranged_rides))
+    ), many=True)
+    # The ride index of this worker may lag behind the commits of the others
+    rides = {
+        ride.id: ride for ride in
+        db.session.query(Ride).filter(Ride.id.in_(ids)).filter(Ride.is_active).
+        options(*schema.eager_load_options()).all()
+    } if ids else {}
+    page = [rides[ride_id] for ride_id in ids if ride_id in rides]
+    response = jsonify(schema.dump(page))
+    return with_next_cursor(response, next_cursor)
 
 
 @api.route('/ride', methods=['PUT'])
@@ -78,6 +136,13 @@ def ride():
         if ride.car_id not in [car.id for car in current_user.cars]:
             raise NotCarOwner()
         ride.submit_datetime = datetime.now().isoformat()
+        try:
+            ride.address = reverse_geocoding_blocking(
+                latitude=ride.latitude, longitude=ride.longitude, degrade=False
+            )['address']
+        except DependencyUnavailable:
+            # Resolved later by `RideJsonSchema` prefetch or `backfill_ride_addresses`
+            ride.address = None
         db.session.add(ride)
         db.session.commit()
         return IdSchema().dump(ride)
@@ -85,16 +150,18 @@ def ride():
 
 @api.route('/ride/passengers', methods=['GET'])
 @login_required
+@query_budget(4)
 def passengers():
-    return jsonify(
-        UserJsonSchema(only=(
-            'first_name', 'last_name', 'photo_url', 'rating', 'id'
-        ), many=True).dump(
-            getattr(
-                db.session.query(Ride).filter_by(**IdSchema().load(request.args)).first(),
-                'passengers', [])
-        )
-    )
+    page = IdPageSchema().load(request.args)
+    ride = db.session.query(Ride).filter_by(id=page['id']).first()
+    if ride is None:
+        return jsonify([])
+    users, next_cursor = paginate(
+        db.session.query(User).with_parent(ride, 'passengers'),
+        [User.id], page['cursor'], page['limit'] or MAX_PAGE_SIZE)
+    return with_next_cursor(jsonify(UserJsonSchema(only=(
+        'first_name', 'last_name', 'photo_url', 'rating', 'id'
+    ), many=True).dump(users)), next_cursor)
 
 
 @api.route('/ride/join', methods=['POST'])
@@ -121,15 +188,23 @@ def ride_join():
 
 @api.route('/ride/history', methods=['GET'])
 @login_required
+@query_budget(3)
 def my_rides_history():
-    all_requests = db.session.query(JoinRideRequest).filter(
-        JoinRideRequest.user == current_user
-    ).all()     # type: List[JoinRideRequest]
-    return jsonify(RideJsonSchema(many=True, only=(
+    schema = RideJsonSchema(many=True, only=(
         'id', 'host', 'organization_name', 'address',
         'submit_datetime', 'start_datetime', 'stop_datetime',
         'price', 'from_organization', 'rating'
-    )).dump([x.ride for x in all_requests if not x.ride.is_active]))
+    ))
+    page = PageSchema().load(request.args)
+    query = db.session.query(Ride).join(Ride.join_requests).\
+        filter(JoinRideRequest.user_id == current_user.id).\
+        filter(Ride.is_active.is_(False)).\
+        options(*schema.eager_load_options())
+    # The most recent rides first
+    rides, next_cursor = paginate(
+        query, [Ride.start_datetime, Ride.id], page['cursor'],
+        page['limit'] or MAX_RIDES_IN_HISTORY, descending=True)     # type: List[Ride]
+    return with_next_cursor(jsonify(schema.dump(rides)), next_cursor)
 
 
 @api.route('/ride/rate', methods=['PUT'])
@@ -150,30 +225,73 @@ def rate_ride():
 
 @api.route('/ride/requests', methods=['GET'])
 @login_required
+@query_budget(3)
 def ride_requests():
-    result = db.session.query(JoinRideRequest).filter(
-        JoinRideRequest.ride_id.in_([x.id for x in current_user.hosted_rides])
-    ).filter_by(status=0).all()     # 0 - not decided
-    return jsonify(JoinRideJsonSchema(many=True, only=(
+    page = PageSchema().load(request.args)
+    query = db.session.query(JoinRideRequest).join(JoinRideRequest.ride).\
+        filter(Ride.host_id == current_user.id).\
+        filter(JoinRideRequest.status == 0).\
+        options(joinedload(JoinRideRequest.user))     # 0 - not decided
+    result, next_cursor = paginate(
+        query, [JoinRideRequest.ride_id, JoinRideRequest.user_id], page['cursor'],
+        page['limit'] or MAX_PAGE_SIZE)
+    return with_next_cursor(jsonify(JoinRideJsonSchema(many=True, only=(
         'ride_id', 'user',
-    )).dump(result))
+    )).dump(result)), next_cursor)
 
 
 @api.route('/ride/hosted', methods=['GET'])
 @login_required
+@query_budget(5)
 def my_hosted_rides():
-    return jsonify(RideJsonSchema(many=True, only=STANDART_RIDE_INFO).dump(
-        filter(lambda ride: ride.is_active, current_user.hosted_rides)))
+    page = PageSchema().load(request.args)
+    schema = RideJsonSchema(many=True, only=STANDART_RIDE_INFO)
+    query = db.session.query(Ride).filter(Ride.host_id == current_user.id).\
+        filter(Ride.is_active).\
+        options(*schema.eager_load_options())
+    rides, next_cursor = paginate(
+        query, [Ride.start_datetime, Ride.id], page['cursor'], page['limit'] or MAX_PAGE_SIZE)
+    return with_next_cursor(jsonify(schema.dump(rides)), next_cursor)
+
+
+def lock_ride(ride_id):
+    """
+    Lock the ride row and re-read it. Every transaction that changes a ride and its join
+    requests takes this lock first, so they cannot deadlock on the two tables.
+    """
+    return db.session.query(Ride).filter(Ride.id == ride_id).\
+        with_for_update().populate_existing().first()
 
 
 def deactivate_ride(ride):
+    """
+    Not committed, so that the ride is deactivated in one transaction with its requests
+    """
     if not ride.is_mine:
         raise InsufficientPermissions()
+    lock_ride(ride.id)
     if not ride.is_active:
         raise RideNotActive()
     ride.is_active = False
     ride.stop_datetime = datetime.now().isoformat()
-    db.session.commit()
+
+
+def decline_join_requests(ride_ids, undecided_only=True):
+    """
+    One `UPDATE` for the join requests of all `ride_ids`, not loaded into the session
+    """
+    query = db.session.query(JoinRideRequest).filter(JoinRideRequest.ride_id.in_(ride_ids))
+    if undecided_only:
+        query = query.filter(JoinRideRequest.status == 0)
+    return query.update({JoinRideRequest.status: -1}, synchronize_session=False)
+
+
+def remove_passengers(ride_ids):
+    db.session.execute(association_user_ride.delete().where(
+        association_user_ride.c.right_id.in_(ride_ids)))
+    db.session.query(Ride).filter(Ride.id.in_(ride_ids)).\
+        update({Ride.occupied_seats: 0}, synchronize_session=False)
+    refresh_rides(ride_ids)
 
 
 @api.route('/ride/finish', methods=['POST'])
@@ -182,9 +300,7 @@ def finish_ride():
     ride = RideJsonSchema(only=('id', )).load(request.json)
     deactivate_ride(ride)
     # Mark all undecided requests as 'DECLINED'
-    for join_request in db.session.query(JoinRideRequest).\
-            filter_by(status=0).filter_by(ride_id=ride.id).all():
-        join_request.status = -1
+    decline_join_requests([ride.id])
     db.session.commit()
     return RideJsonSchema(only=('id', )).dump(ride)
 
@@ -195,46 +311,77 @@ def cancel_ride():
     ride = RideJsonSchema(only=('id', )).load(request.json)
     deactivate_ride(ride)
     # Remove all passengers
-    ride.passengers = []
+    remove_passengers([ride.id])
     # Mark all join requests as `DECLINED`
-    for join_request in db.session.query(JoinRideRequest).filter_by(ride_id=ride.id).all():
-        join_request.status = -1
+    decline_join_requests([ride.id], undecided_only=False)
     db.session.commit()
     return RideJsonSchema(only=('id', )).dump(ride)
 
 
-def process_join_request(join_request: JoinRideRequest, action: str):
-    if join_request.user is None or join_request.ride is None:
-        # Not found in DB
-        raise InsufficientPermissions()
-    if join_request.ride.host != current_user:
+def decide_join_requests(ride_id, user_ids, action, decline_reason=None):
+    """
+    Accept or decline the undecided requests of `user_ids` to the ride of the current user.
+    Accepted users take their seats and become passengers in the same transaction,
+    if there are not enough free seats for all of them nothing is accepted.
+
+    :return: ids of the users whose requests were decided by this call
+    """
+    ride = lock_ride(ride_id)
+    if ride is None or ride.host_id != current_user.id:
         raise InsufficientPermissions()
-    if join_request.status != 0:
-        raise AlreadyDecided()
     if action == 'ACCEPT':
-        if join_request.ride.free_seats < 1:
-            raise NoFreeSeats()
-        join_request.status = 1
+        decided = JoinRideRequest.decide(ride_id, user_ids, 1)
+        if decided:
+            if not ride.reserve_seats(len(decided)):
+                db.session.rollback()
+                raise NoFreeSeats()
+            refresh_rides([ride_id])
+            db.session.execute(association_user_ride.insert(), [
+                {'left_id': user_id, 'right_id': ride_id} for user_id in decided
+            ])
     elif action == 'DECLINE':
-        join_request.status = -1
+        decided = JoinRideRequest.decide(ride_id, user_ids, -1, decline_reason)
     db.session.commit()
+    return decided
+
+
+def process_join_request(data, action):
+    if not decide_join_requests(
+            data['ride_id'], [data['user_id']], action, data['decline_reason']):
+        exists = db.session.query(JoinRideRequest.status).\
+            filter_by(ride_id=data['ride_id'], user_id=data['user_id']).first()
+        if exists is None:
+            # Not found in DB
+            raise InsufficientPermissions()
+        raise AlreadyDecided()
 
 
 @api.route('/ride/request/accept', methods=['POST'])
 @login_required
 def accept_request():
-    join_request = JoinRideJsonSchema(only=('user_id', 'ride_id')).load(request.json)
-    process_join_request(join_request, 'ACCEPT')
-    # Add to passengers
-    join_request.ride.passengers.append(join_request.user)
-    db.session.commit()
+    data = JoinRequestDecisionSchema().load(request.json)
+    process_join_request(data, 'ACCEPT')
     return 'ok'
 
 
 @api.route('/ride/request/decline', methods=['POST'])
 @login_required
 def decline_request():
-    join_request = JoinRideJsonSchema(
-        only=('user_id', 'ride_id', 'decline_reason')).load(request.json)
-    process_join_request(join_request, 'DECLINE')
+    data = JoinRequestDecisionSchema().load(request.json)
+    process_join_request(data, 'DECLINE')
     return 'ok'
+
+
+@api.route('/ride/requests/accept', methods=['POST'])
+@login_required
+def accept_requests():
+    data = JoinRequestsDecisionSchema().load(request.json)
+    return jsonify(userIds=decide_join_requests(data['ride_id'], data['user_ids'], 'ACCEPT'))
+
+
+@api.route('/ride/requests/decline', methods=['POST'])
+@login_required
+def decline_requests():
+    data = JoinRequestsDecisionSchema().load(request.json)
+    return jsonify(userIds=decide_join_requests(
+        data['ride_id'], data['user_ids'], 'DECLINE', data['decline_reason']))
@@ -1,26 +1,34 @@
-import requests
 from flask import jsonify, request, current_app
 from flask_login import login_required, current_user
 
-from main_app.model import User
+from main_app.model import User, Organization
 from main_app.schemas import OrganizationJsonSchema, UserJsonSchema, \
     PasswordChangeSchema, UploadFileSchema, UserChangeSchema, SearchSchema, \
-    UpdateFirebaseIdSchema
+    UpdateFirebaseIdSchema, PageSchema
 from main_app.exceptions.custom import InsufficientPermissions, InvalidCredentials
 from app import db
 from main_app.views import api
+from main_app.query_stats import query_budget
+from main_app.pagination import paginate, paginate_search, with_next_cursor
+from settings import MAX_PAGE_SIZE, SEARCH_PAGE_SIZE
 
 
 @api.route('/user/organizations', methods=['GET'])
 @login_required
+@query_budget(2)
 def organizations():
-    return jsonify(OrganizationJsonSchema(only=('id', 'name', 'address'), many=True).dump(
-        current_user.organizations
-    ))
+    page = PageSchema().load(request.args)
+    result, next_cursor = paginate(
+        db.session.query(Organization).with_parent(current_user, 'organizations'),
+        [Organization.id], page['cursor'], page['limit'] or MAX_PAGE_SIZE)
+    return with_next_cursor(jsonify(
+        OrganizationJsonSchema(only=('id', 'name', 'address'), many=True).dump(result)
+    ), next_cursor)
 
 
 @api.route('/user', methods=['GET', 'POST'])
 @login_required
+@query_budget(2)
 def user():
     if request.method == 'GET':
         user = UserJsonSchema(only=('id', )).load(request.args)
@@ -85,18 +93,20 @@ def user_avatar_sign_s3():
 @login_required
 def search_users():
     query_string = SearchSchema().load(request.args)
-    results, total = User.search(query_string['query'], 1, 10)
-    return jsonify(UserJsonSchema(many=True, only=(
+    results, next_cursor = paginate_search(
+        User, query_string['query'], query_string['cursor'],
+        query_string['limit'] or SEARCH_PAGE_SIZE)
+    return with_next_cursor(jsonify(UserJsonSchema(many=True, only=(
         'id', 'first_name', 'last_name', 'phone_number', 'email', 'photo_url'
-    )).dump(results))
+    )).dump(results)), next_cursor)
 
 
 @api.route('/user/updateFirebaseRegistrationToken', methods=['POST'])
 @login_required
 def update_firebase_id():
     data = UpdateFirebaseIdSchema().load(request.json)
-    response = requests.post(
-        f"{current_app.config['FCM_BACKEND_URL']}/update_token/",
+    response = current_app.outbound.post(
+        'fcm', f"{current_app.config['FCM_BACKEND_URL']}/update_token/",
         data={'id': current_user.id, 'token': data['token']}
     )
     current_app.logger.info(f'response from FCM: {(response.content, response.status_code)}')
@@ -1,9 +1,51 @@
 from flask_migrate import MigrateCommand, Manager
 
-from app import create_app
+from app import create_app, db
 
 manager = Manager(create_app)
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def backfill_ride_addresses(batch_size=100):
+    """Resolve and store addresses for rides created before `ride.address` existed"""
+    from main_app.model import Ride
+    from main_app.misc import reverse_geocoding_batch
+    total = 0
+    while True:
+        rides = db.session.query(Ride).filter(Ride.address.is_(None)).\
+            limit(int(batch_size)).all()
+        if not rides:
+            break
+        results = reverse_geocoding_batch(
+            [(ride.latitude, ride.longitude) for ride in rides], degrade=False)
+        for ride, result in zip(rides, results):
+            ride.address = result['address']
+        # Commit batch by batch, so an interrupted backfill does not lose progress
+        db.session.commit()
+        total += len(rides)
+    print(f'Backfilled {total} rides')
+
+
+@manager.command
+def backfill_ratings():
+    """Recompute stored `rating_sum`/`rating_count` of users and rides from their feedback"""
+    from main_app.ratings import backfill_ratings as backfill
+    for model, updated in backfill().items():
+        print(f'{model}: fixed {updated} rows')
+
+
+@manager.command
+def check_ratings():
+    """Report users and rides whose stored rating counters disagree with their feedback"""
+    from main_app.ratings import find_rating_mismatches
+    mismatches = find_rating_mismatches()
+    for model, id, stored, actual in mismatches:
+        print(f'{model} {id}: stored (sum, count) = {stored}, actual = {actual}')
+    print(f'{len(mismatches)} mismatches found')
+    if mismatches:
+        raise SystemExit(1)
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,29 @@
+"""add_geocoding_cache_table
+
+Revision ID: 4c8e0d7a1b95
+Revises: b3f1c2a9d4e7
+Create Date: 2026-10-18 11:20:43.905114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c8e0d7a1b95'
+down_revision = 'b3f1c2a9d4e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('geocoding_cache',
+    sa.Column('key', sa.String(length=700), nullable=False),
+    sa.Column('value', sa.Text(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('key', name=op.f('pk_geocoding_cache'))
+    )
+
+
+def downgrade():
+    op.drop_table('geocoding_cache')
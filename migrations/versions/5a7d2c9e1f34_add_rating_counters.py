@@ -0,0 +1,46 @@
+"""add_rating_counters
+
+Revision ID: 5a7d2c9e1f34
+Revises: e91a5f3c7d20
+Create Date: 2026-10-18 14:20:37.502113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a7d2c9e1f34'
+down_revision = 'e91a5f3c7d20'
+branch_labels = None
+depends_on = None
+
+# (rated table, feedback table, foreign key)
+RATED = (
+    ('user', 'userfeedback', 'user_id'),
+    ('ride', 'ridefeedback', 'ride_id'),
+)
+
+
+def upgrade():
+    for rated, feedback, foreign_key in RATED:
+        op.add_column(rated, sa.Column(
+            'rating_sum', sa.Integer(), server_default='0', nullable=False))
+        op.add_column(rated, sa.Column(
+            'rating_count', sa.Integer(), server_default='0', nullable=False))
+        # Same as `python manage.py backfill_ratings`
+        rated_table = sa.table(
+            rated, sa.column('id'), sa.column('rating_sum'), sa.column('rating_count'))
+        feedback_table = sa.table(feedback, sa.column('rate'), sa.column(foreign_key))
+        reviews = sa.select([sa.func.coalesce(sa.func.sum(feedback_table.c.rate), 0)]).\
+            where(feedback_table.c[foreign_key] == rated_table.c.id)
+        count = sa.select([sa.func.count()]).\
+            where(feedback_table.c[foreign_key] == rated_table.c.id)
+        op.execute(rated_table.update().values(
+            rating_sum=reviews.as_scalar(), rating_count=count.as_scalar()))
+
+
+def downgrade():
+    for rated, _, _ in RATED:
+        op.drop_column(rated, 'rating_count')
+        op.drop_column(rated, 'rating_sum')
@@ -0,0 +1,29 @@
+"""add_ride_occupied_seats
+
+Revision ID: 9b2e6f4a8c11
+Revises: 5a7d2c9e1f34
+Create Date: 2026-10-18 15:41:09.127734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b2e6f4a8c11'
+down_revision = '5a7d2c9e1f34'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('ride', sa.Column(
+        'occupied_seats', sa.Integer(), server_default='0', nullable=False))
+    ride = sa.table('ride', sa.column('id'), sa.column('occupied_seats'))
+    passengers = sa.table('association_user_ride', sa.column('right_id'))
+    op.execute(ride.update().values(occupied_seats=sa.select([sa.func.count()]).
+                                    where(passengers.c.right_id == ride.c.id).as_scalar()))
+
+
+def downgrade():
+    op.drop_column('ride', 'occupied_seats')
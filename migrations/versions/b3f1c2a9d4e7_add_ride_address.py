@@ -0,0 +1,25 @@
+"""add_ride_address
+
+Revision ID: b3f1c2a9d4e7
+Revises: 7155b49f8c80
+Create Date: 2026-10-18 10:02:11.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3f1c2a9d4e7'
+down_revision = '7155b49f8c80'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing rows stay NULL until `python manage.py backfill_ride_addresses` is run
+    op.add_column('ride', sa.Column('address', sa.String(length=600), nullable=True))
+
+
+def downgrade():
+    op.drop_column('ride', 'address')
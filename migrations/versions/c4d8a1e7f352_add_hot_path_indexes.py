@@ -0,0 +1,48 @@
+"""add_hot_path_indexes
+
+Revision ID: c4d8a1e7f352
+Revises: 9b2e6f4a8c11
+Create Date: 2026-10-18 16:52:44.901266
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d8a1e7f352'
+down_revision = '9b2e6f4a8c11'
+branch_labels = None
+depends_on = None
+
+# (name, table, columns), see `benchmarks/explain.py` for the queries they serve
+INDEXES = (
+    ('ix_user_phone_number', 'user', ['phone_number']),
+    ('ix_car_owner_id', 'car', ['owner_id']),
+    ('ix_userfeedback_user_id', 'userfeedback', ['user_id']),
+    ('ix_ridefeedback_ride_id', 'ridefeedback', ['ride_id']),
+    ('ix_association_user_organization_left_id', 'association_user_organization', ['left_id']),
+    ('ix_association_user_organization_right_id', 'association_user_organization', ['right_id']),
+    ('ix_association_user_ride_left_id', 'association_user_ride', ['left_id']),
+    ('ix_association_user_ride_right_id', 'association_user_ride', ['right_id']),
+    ('ix_join_ride_request_ride_id_status', 'join_ride_request', ['ride_id', 'status']),
+    ('ix_ride_organization_id', 'ride', ['organization_id']),
+)
+# Only active rides are matched and listed as hosted, finished ones pile up forever
+PARTIAL_INDEXES = (
+    ('ix_ride_active_match', 'ride', ['organization_id', 'from_organization', 'start_datetime']),
+    ('ix_ride_active_host', 'ride', ['host_id', 'start_datetime', 'id']),
+)
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns)
+    for name, table, columns in PARTIAL_INDEXES:
+        op.create_index(name, table, columns,
+                        postgresql_where=sa.text('is_active'), sqlite_where=sa.text('is_active'))
+
+
+def downgrade():
+    for name, table, _ in reversed(INDEXES + PARTIAL_INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,24 @@
+"""add_geocoding_cache_lease
+
+Revision ID: e91a5f3c7d20
+Revises: 4c8e0d7a1b95
+Create Date: 2026-10-18 12:41:05.117342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e91a5f3c7d20'
+down_revision = '4c8e0d7a1b95'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('geocoding_cache', sa.Column('lease_until', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('geocoding_cache', 'lease_until')
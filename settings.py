@@ -8,6 +8,18 @@ MAX_NAME_LENGTH = 40
 MAX_SURNAME_LENGTH = 40
 MAX_URL_LENGTH = 2000
 BLUEPRINT_API_NAME = 'api'
+# `/ride/match` defaults
+MATCH_MAX_DISTANCE_KM = 30
+MATCH_TIME_WINDOW_MINUTES = 24 * 60
+MAX_MATCHED_RIDES = 30
+# Rides nearest to the pickup point scored by the matching engine, bounds the work of every page
+MATCH_MAX_CANDIDATES = 1000
+# Upper bound for `limit` of any paginated endpoint
+MAX_PAGE_SIZE = 100
+# Default page size of the Elasticsearch backed search endpoints
+SEARCH_PAGE_SIZE = 10
+# Rows fetched from the DB cursor at once by streaming endpoints
+STREAM_CHUNK_SIZE = 100
 
 
 class Config:
@@ -16,6 +28,23 @@ class Config:
     """
     SECRET_KEY = os.environ['SECRET_KEY']
     SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL']
+    # Optional read replica, GET requests read from it (see `main_app.routing`)
+    SQLALCHEMY_BINDS = {'replica': os.environ['DATABASE_REPLICA_URL']} \
+        if os.environ.get('DATABASE_REPLICA_URL') else None
+    # Pool of every engine, per worker process: size it by the worker count and DB max_connections
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        # Seconds, connections are reopened before the server or a proxy drops them
+        'pool_recycle': int(os.environ.get('DATABASE_POOL_RECYCLE', 1800)),
+        # Cheap ping on checkout instead of an error after a DB restart
+        'pool_pre_ping': os.environ.get('DATABASE_POOL_PRE_PING', 'true').lower() == 'true',
+        # SQLite is not served by a queue pool
+        **({} if SQLALCHEMY_DATABASE_URI.startswith('sqlite') else {
+            'pool_size': int(os.environ.get('DATABASE_POOL_SIZE', 5)),
+            'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', 10)),
+            # Seconds to wait for a free connection
+            'pool_timeout': float(os.environ.get('DATABASE_POOL_TIMEOUT', 30)),
+        }),
+    }
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
     PORT = os.environ.get('PORT', 5000)
 
@@ -26,5 +55,70 @@ class Config:
     TESTING = os.environ.get('TESTING', False)
     FCM_BACKEND_URL = os.environ.get('FCM_BACKEND_URL')
 
+    # Coordinates are rounded to this number of digits before cache lookup (4 digits ~ 10m)
+    GEOCODING_CACHE_PRECISION = int(os.environ.get('GEOCODING_CACHE_PRECISION', 4))
+    # Seconds
+    GEOCODING_CACHE_TTL = int(os.environ.get('GEOCODING_CACHE_TTL', 30 * 24 * 60 * 60))
+    # Max entries in the in-process tier of every worker
+    GEOCODING_CACHE_SIZE = int(os.environ.get('GEOCODING_CACHE_SIZE', 10000))
+    # Max concurrent geocoder requests of `reverse_geocoding_batch` per worker
+    GEOCODING_BATCH_WORKERS = int(os.environ.get('GEOCODING_BATCH_WORKERS', 8))
+    # Same for `/encode_address` queries
+    FORWARD_GEOCODING_CACHE_TTL = int(os.environ.get('FORWARD_GEOCODING_CACHE_TTL', 24 * 60 * 60))
+    FORWARD_GEOCODING_CACHE_SIZE = int(os.environ.get('FORWARD_GEOCODING_CACHE_SIZE', 10000))
+    # Queries with no results are remembered for a shorter time and only in-process
+    GEOCODING_NEGATIVE_CACHE_TTL = int(os.environ.get('GEOCODING_NEGATIVE_CACHE_TTL', 10 * 60))
+    # Workers wait up to this many seconds for another worker that is resolving the same key
+    GEOCODING_LEASE_TIMEOUT = float(os.environ.get('GEOCODING_LEASE_TIMEOUT', 5))
+    # Shortest cached prefix whose candidates may be reused for a longer query
+    GEOCODING_PREFIX_MIN_LENGTH = int(os.environ.get('GEOCODING_PREFIX_MIN_LENGTH', 3))
+
+    # Outbound HTTP calls, see `main_app.outbound`. Timeouts are in seconds
+    OUTBOUND_POOL_SIZE = int(os.environ.get('OUTBOUND_POOL_SIZE', 10))
+    OUTBOUND_RETRY_BACKOFF = float(os.environ.get('OUTBOUND_RETRY_BACKOFF', 0.3))
+    YANDEX_CONNECT_TIMEOUT = float(os.environ.get('YANDEX_CONNECT_TIMEOUT', 3.05))
+    YANDEX_READ_TIMEOUT = float(os.environ.get('YANDEX_READ_TIMEOUT', 5))
+    YANDEX_RETRIES = int(os.environ.get('YANDEX_RETRIES', 2))
+    FCM_CONNECT_TIMEOUT = float(os.environ.get('FCM_CONNECT_TIMEOUT', 3.05))
+    FCM_READ_TIMEOUT = float(os.environ.get('FCM_READ_TIMEOUT', 10))
+    # FCM backend calls have side effects even when sent with GET
+    FCM_RETRIES = int(os.environ.get('FCM_RETRIES', 0))
+    # Per worker rate limits (calls per second, 0 - no limit) and circuit breakers
+    # (consecutive failures to open, 0 - never open; seconds before a trial call)
+    YANDEX_RATE_LIMIT = float(os.environ.get('YANDEX_RATE_LIMIT', 10))
+    YANDEX_RATE_BURST = int(os.environ.get('YANDEX_RATE_BURST', 20))
+    YANDEX_BREAKER_THRESHOLD = int(os.environ.get('YANDEX_BREAKER_THRESHOLD', 5))
+    YANDEX_BREAKER_RESET_TIMEOUT = float(os.environ.get('YANDEX_BREAKER_RESET_TIMEOUT', 30))
+    FCM_RATE_LIMIT = float(os.environ.get('FCM_RATE_LIMIT', 0))
+    FCM_RATE_BURST = int(os.environ.get('FCM_RATE_BURST', 1))
+    FCM_BREAKER_THRESHOLD = int(os.environ.get('FCM_BREAKER_THRESHOLD', 5))
+    FCM_BREAKER_RESET_TIMEOUT = float(os.environ.get('FCM_BREAKER_RESET_TIMEOUT', 30))
+    ELASTICSEARCH_RATE_LIMIT = float(os.environ.get('ELASTICSEARCH_RATE_LIMIT', 0))
+    ELASTICSEARCH_RATE_BURST = int(os.environ.get('ELASTICSEARCH_RATE_BURST', 1))
+    ELASTICSEARCH_BREAKER_THRESHOLD = int(os.environ.get('ELASTICSEARCH_BREAKER_THRESHOLD', 5))
+    ELASTICSEARCH_BREAKER_RESET_TIMEOUT = float(
+        os.environ.get('ELASTICSEARCH_BREAKER_RESET_TIMEOUT', 30))
+
+    # `/ride/match` score per km, per minute of start time difference, per price unit
+    # and per free seat (subtracted), see `main_app.matching.MatchingEngine`
+    MATCH_DISTANCE_WEIGHT = float(os.environ.get('MATCH_DISTANCE_WEIGHT', 1))
+    MATCH_TIME_WEIGHT = float(os.environ.get('MATCH_TIME_WEIGHT', 0))
+    MATCH_PRICE_WEIGHT = float(os.environ.get('MATCH_PRICE_WEIGHT', 0))
+    MATCH_SEATS_WEIGHT = float(os.environ.get('MATCH_SEATS_WEIGHT', 0))
+    # In-process spatial index for `/ride/match`, see `main_app.ride_index`
+    RIDE_INDEX_ENABLED = os.environ.get('RIDE_INDEX_ENABLED', 'false').lower() == 'true'
+    # Grid cell side, degrees
+    RIDE_INDEX_CELL_SIZE = float(os.environ.get('RIDE_INDEX_CELL_SIZE', 0.01))
+    # Seconds before a group is reloaded to pick up rides committed by other workers
+    RIDE_INDEX_TTL = float(os.environ.get('RIDE_INDEX_TTL', 60))
+
+    # Statements count, DB time and N+1 suspects of every request in `X-Query-*` headers
+    QUERY_STATS_HEADERS = os.environ.get(
+        'QUERY_STATS_HEADERS', os.environ.get('DEBUG', 'false')).lower() == 'true'
+    # Share of requests whose query stats are logged
+    QUERY_STATS_SAMPLE_RATE = float(os.environ.get('QUERY_STATS_SAMPLE_RATE', 0.01))
+    # Same statement executed this many times in a request is reported as an N+1 suspect
+    N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+
     S3_BUCKET = os.environ.get('S3_BUCKET')
     S3_URL = os.environ.get('S3_URL')
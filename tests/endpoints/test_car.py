@@ -5,6 +5,7 @@ from app import db
 from settings import BLUEPRINT_API_NAME
 from main_app.schemas import CarSchema, IdSchema
 from main_app.model import Car, User
+from main_app.pagination import NEXT_CURSOR_HEADER, encode_cursor
 from main_app.views.car import car as endpoint
 from . import TestWithDatabase
 
@@ -22,6 +23,18 @@ class BasicTest(TestWithDatabase):
             # `Car` schema is simple, so we can directly try loading it
             CarSchema(many=True).load(response.json)
 
+    def test_get_car_pagination(self):
+        owner = db.session.query(Car).first().owner
+        with login_as(self.client, owner):
+            response = self.client.get(self.url, query_string={'limit': 1})
+            self.assert200(response)
+            self.assertEqual([min(x.id for x in owner.cars)], [x['id'] for x in response.json])
+            self.assertEqual(len(owner.cars) > 1, NEXT_CURSOR_HEADER in response.headers)
+            response = self.client.get(self.url, query_string={'cursor': 'not a cursor'})
+            self.assert400(response)
+            response = self.client.get(self.url, query_string={'cursor': encode_cursor(['abc'])})
+            self.assert400(response)
+
     def test_put_car(self):
         with login_as(self.client, db.session.query(User).first()):
             response = self.client.put(self.url, json={
@@ -1,13 +1,20 @@
+import json
 from flask import url_for
+from sqlalchemy import event
 import unittest
 
-from app import db
-from settings import BLUEPRINT_API_NAME
-from main_app.views.organization import organization as endpoint
-from main_app.schemas import OrganizationJsonSchema, IdSchema, UserJsonSchema
+from app import create_app, db
+from settings import BLUEPRINT_API_NAME, STREAM_CHUNK_SIZE
+from main_app.views.organization import organization as endpoint, get_all_organizations
+from main_app.views.user_and_driver import organizations
+from main_app.schemas import OrganizationJsonSchema, IdSchema, UserJsonSchema, \
+    OrganizationSchemaUserInfo
 from main_app.exceptions.custom import NotInOrganization, CreatorCannotLeave
 from tests import login_as
 from main_app.model import Organization, User
+from main_app.pagination import NEXT_CURSOR_HEADER, encode_cursor
+from main_app.routing import REPLICA_BIND
+from main_app.query_stats import N_PLUS_ONE_HEADER, QUERY_COUNT_HEADER, QUERY_TIME_HEADER
 from . import TestWithDatabase
 
 
@@ -37,6 +44,24 @@ class BasicTest(TestWithDatabase):
         self.assert200(response)
         self.assertEqual(schema.dump(organization), response.json)
 
+    def test_organization_stats(self):
+        organization = db.session.query(Organization).filter_by(id=1).first()
+        self.assertEqual(len(organization.users), organization.total_members)
+        self.assertEqual(
+            sum(len(user.cars) > 0 for user in organization.users), organization.total_drivers)
+        self.assertEqual(min(x.price for x in organization.rides), organization.min_ride_cost)
+        self.assertEqual(max(x.price for x in organization.rides), organization.max_ride_cost)
+        self.assertEqual(
+            max(x.submit_datetime for x in organization.rides), organization.last_ride_datetime)
+        empty = Organization(name='empty', latitude=0, longitude=0, creator=organization.creator)
+        db.session.add(empty)
+        db.session.commit()
+        self.assertEqual(('-', '-', 1), (empty.min_ride_cost, empty.last_ride_datetime,
+                                         empty.total_members))
+        self.assertEqual(
+            [organization.id],
+            [x for x, in db.session.query(Organization.id).filter(Organization.total_members > 1)])
+
     def test_put_organization(self):
         json = {
             'name': 'org1',
@@ -105,6 +130,71 @@ class BasicTest(TestWithDatabase):
                 many=True
             ).load(response.json['members'])
 
+    def test_organization_members_pagination(self):
+        organization = db.session.query(Organization).filter_by(id=1).first()
+        self.assertGreater(len(organization.users), 1)
+        ids, cursor = [], None
+        with login_as(self.client, organization.creator):
+            while True:
+                response = self.client.get(f'{self.url}/members', query_string={
+                    'id': organization.id, 'limit': 1, **({'cursor': cursor} if cursor else {})
+                })
+                self.assert200(response)
+                self.assertLessEqual(len(response.json['members']), 1)
+                ids.extend(x['id'] for x in response.json['members'])
+                cursor = response.headers.get(NEXT_CURSOR_HEADER)
+                if not cursor:
+                    break
+        self.assertEqual(sorted(x.id for x in organization.users), ids)
+
+    def test_user_organizations_invalid_cursor(self):
+        with login_as(self.client, db.session.query(User).first()):
+            response = self.client.get(
+                url_for(f'{BLUEPRINT_API_NAME}.{organizations.__name__}'),
+                query_string={'cursor': encode_cursor([[1]])})
+            self.assert400(response)
+
+    def test_get_all_organizations_stream(self):
+        with login_as(self.client, db.session.query(User).first()):
+            response = self.client.get(
+                url_for(f'{BLUEPRINT_API_NAME}.{get_all_organizations.__name__}'),
+                query_string={'stream': True})
+            self.assert200(response)
+            self.assertTrue(response.is_streamed)
+        organizations = db.session.query(Organization).order_by(Organization.id).all()
+        self.assertEqual(
+            OrganizationSchemaUserInfo(many=True).dump(organizations), response.json)
+
+    def test_get_all_organizations_stream_many_chunks(self):
+        creator = db.session.query(User).first()
+        db.session.add_all(
+            Organization(name=f'Organization {i}', latitude=55., longitude=37., creator=creator)
+            for i in range(STREAM_CHUNK_SIZE + 1)
+        )
+        db.session.commit()
+        with login_as(self.client, creator):
+            response = self.client.get(
+                url_for(f'{BLUEPRINT_API_NAME}.{get_all_organizations.__name__}'),
+                query_string={'stream': True})
+            self.assert200(response)
+            organizations = json.loads(response.get_data(as_text=True))
+        self.assertGreater(len(organizations), STREAM_CHUNK_SIZE)
+        self.assertEqual(
+            [x for x, in db.session.query(Organization.id).order_by(Organization.id)],
+            [x['id'] for x in organizations])
+
+    def test_query_stats_headers(self):
+        self.app.config['QUERY_STATS_HEADERS'] = True
+        self.app.config['N_PLUS_ONE_THRESHOLD'] = 2
+        organization = db.session.query(Organization).filter_by(id=1).first()
+        with login_as(self.client, organization.creator):
+            response = self.client.get(f'{self.url}/members', query_string={'id': 1})
+        self.assert200(response)
+        self.assertGreater(int(response.headers[QUERY_COUNT_HEADER]), 0)
+        self.assertGreaterEqual(float(response.headers[QUERY_TIME_HEADER]), 0)
+        # Members are loaded by one query, not one per member
+        self.assertEqual('0', response.headers[N_PLUS_ONE_HEADER])
+
     def test_organization_question_get(self):
         ID = 1
         query_params = {
@@ -174,3 +264,55 @@ class BasicTest(TestWithDatabase):
                 self.assert403(response)
                 # Error message
                 self.assertEqual(NotInOrganization.description, response.json.get('description'))
+
+
+class ReplicaRoutingTest(TestWithDatabase):
+
+    def create_app(self):
+        app = create_app()
+        # The replica is the same database, only the engine tells where statements went
+        app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: app.config['SQLALCHEMY_DATABASE_URI']}
+        return app
+
+    def setUp(self):
+        super().setUp()
+        self.url = url_for(f'{BLUEPRINT_API_NAME}.{endpoint.__name__}')
+        self.replica = db.get_engine(self.app, bind=REPLICA_BIND)
+        self.replica_statements = []
+        event.listen(self.replica, 'before_cursor_execute', self._on_replica)
+
+    def tearDown(self):
+        event.remove(self.replica, 'before_cursor_execute', self._on_replica)
+        super().tearDown()
+
+    def _on_replica(self, conn, cursor, statement, *args):
+        self.replica_statements.append(statement)
+
+    def _request(self, method, **kwargs):
+        creator = db.session.query(Organization).filter_by(id=1).first().creator
+        with login_as(self.client, creator):
+            # Otherwise the request shares the DB session with the test, which wrote the fixtures
+            with self.app.app_context():
+                del self.replica_statements[:]
+                response = self.client.open(self.url, method=method, **kwargs)
+        self.assert200(response)
+        return self.replica_statements
+
+    def test_get_reads_from_replica(self):
+        self.assertTrue(self._request('GET', query_string={'id': 1}))
+
+    def test_write_goes_to_primary(self):
+        self.assertEqual([], self._request('POST', json={
+            'id': 1, 'name': 'renamed', 'latitude': 55.5, 'longitude': 37.5,
+        }))
+
+    def test_read_after_write_goes_to_primary(self):
+        select = db.session.query(Organization).statement
+        with self.app.test_request_context(method='GET'):
+            db.session.remove()
+            self.assertIs(self.replica, db.session.get_bind(clause=select))
+            db.session.add(Organization(
+                name='new', latitude=0, longitude=0, creator=db.session.query(User).first()))
+            db.session.flush()
+            self.assertIs(db.get_engine(self.app), db.session.get_bind(clause=select))
+            db.session.rollback()
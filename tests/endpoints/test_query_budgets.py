@@ -0,0 +1,105 @@
+from flask import url_for
+
+from app import db
+from fill_db import fill_database
+from main_app.model import JoinRideRequest, Organization, Ride
+from main_app.query_stats import QUERY_COUNT_HEADER
+from tests import login_as
+from . import TestWithDatabase
+
+# Every scenario of `fill_database` is repeated this many times in the second run
+LARGE_SCALE = 4
+
+
+def _member():
+    return db.session.query(JoinRideRequest).filter_by(status=0).first().user
+
+
+def _host():
+    return db.session.query(JoinRideRequest).filter_by(status=0).first().ride.host
+
+
+def _organization():
+    return db.session.query(Organization).first()
+
+
+def _accepted_ride():
+    return db.session.query(JoinRideRequest).filter_by(status=1).first().ride
+
+
+def _passenger():
+    return db.session.query(JoinRideRequest).filter_by(status=1).\
+        join(JoinRideRequest.ride).filter(Ride.is_active.is_(False)).first().user
+
+
+# Endpoint -> (user, query args) of a GET request that returns every row it can
+REQUESTS = {
+    'active_rides': lambda: (_member(), {}),
+    'match_ride': lambda: (_member(), {
+        'organizationId': _organization().id,
+        'latitude': 55.5, 'longitude': 37.5, 'fromOrganization': True,
+        'maxDistance': 200, 'timeWindow': 24 * 60,
+    }),
+    'passengers': lambda: (_member(), {'id': _accepted_ride().id}),
+    'my_rides_history': lambda: (_passenger(), {}),
+    'ride_requests': lambda: (_host(), {}),
+    'my_hosted_rides': lambda: (_host(), {}),
+    'organization': lambda: (_member(), {'id': _organization().id}),
+    'organization_members': lambda: (_member(), {'id': _organization().id}),
+    'question': lambda: (_member(), {'id': _organization().id}),
+    'get_all_organizations': lambda: (_member(), {}),
+    'organizations': lambda: (_member(), {}),
+    'user': lambda: (_member(), {}),
+    'car': lambda: (_host(), {}),
+    'get_my_cars': lambda: (_host(), {}),
+}
+
+
+class QueryBudgetTest(TestWithDatabase):
+    """
+    Statements of every view with a `query_budget` on a small and a large dataset
+    """
+
+    def _budgets(self):
+        return {
+            endpoint.split('.')[-1]: view.query_budget
+            for endpoint, view in self.app.view_functions.items()
+            if hasattr(view, 'query_budget')
+        }
+
+    def _count_queries(self, scale):
+        # Releases the locks of the test session before the tables are recreated
+        db.session.remove()
+        fill_database(self.app, scale=scale)
+        # Finished rides go to the history
+        db.session.query(Ride).filter(Ride.stop_datetime.isnot(None)).\
+            update({Ride.is_active: False}, synchronize_session=False)
+        db.session.commit()
+        counts = {}
+        for endpoint, request in REQUESTS.items():
+            user, args = request()
+            url = url_for(f'api.{endpoint}')
+            with login_as(self.client, user):
+                # The first request warms up per-process caches
+                self.client.get(url, query_string=args)
+                # Otherwise requests share `g` and the DB session with the test,
+                # and the objects already loaded by it are not queried again
+                with self.app.app_context():
+                    db.session.remove()
+                    response = self.client.get(url, query_string=args)
+            self.assert200(response, endpoint)
+            counts[endpoint] = int(response.headers[QUERY_COUNT_HEADER])
+        return counts
+
+    def test_every_budget_is_checked(self):
+        self.assertEqual(set(self._budgets()), set(REQUESTS))
+
+    def test_query_count_does_not_grow(self):
+        self.app.config['QUERY_STATS_HEADERS'] = True
+        budgets = self._budgets()
+        small, large = self._count_queries(1), self._count_queries(LARGE_SCALE)
+        for endpoint, budget in budgets.items():
+            with self.subTest(endpoint):
+                self.assertLessEqual(small[endpoint], budget)
+                self.assertLessEqual(large[endpoint], budget)
+                self.assertEqual(small[endpoint], large[endpoint])
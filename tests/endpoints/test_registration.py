@@ -15,12 +15,13 @@ class BasicRegistrationTests(TestWithDatabase):
         super().setUp()
         self.url = url_for(f'{BLUEPRINT_API_NAME}.{auth.register_user.__name__}')
 
-    def _register_fixture(self):
+    def _register_fixture(self, **fields):
         user_json = {'email': 'registered@gmail.com',
                      'password': '12345',
                      'phoneNumber': '+7 (950) 001-01-01',
                      'firstName': 'Yaya',
-                     'lastName': 'Test'}
+                     'lastName': 'Test',
+                     **fields}
         response = self.client.post(self.url, json=user_json)
         return response
 
@@ -41,6 +42,11 @@ class BasicRegistrationTests(TestWithDatabase):
             db.session.query(User).filter_by(**UserIDSchema().load(response.json)).first(),
             User)
 
+    def test_rating_counters_are_not_loaded(self):
+        response = self._register_fixture(ratingSum=10, ratingCount=1)
+        self.assert400(response)
+        self.assertIsNone(db.session.query(User).filter_by(email='registered@gmail.com').first())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,495 @@
+import os
+import threading
+import time
+import unittest
+from datetime import timedelta, timezone
+from unittest import mock
+
+from flask import url_for
+from flask_login import login_user
+
+from app import db
+from settings import BLUEPRINT_API_NAME
+from main_app.cache import reverse_geocoding_key
+from main_app.geo import haversine_km
+from main_app.model import JoinRideRequest, Organization, Ride
+from main_app.pagination import NEXT_CURSOR_HEADER, encode_cursor
+from main_app.schemas import RideJsonSchema
+from main_app.ratings import find_rating_mismatches
+from main_app.exceptions.custom import AlreadyDecided, NoFreeSeats, RideNotActive
+from main_app.fixtures.rides import RideFactory
+from main_app.ride_index import RideGridIndex, refresh_rides
+from main_app.views.ride import accept_request, accept_requests, active_rides, cancel_ride, \
+    decline_request, decline_requests, finish_ride, match_ride, my_rides_history, rate_ride
+from tests import login_as
+from . import TestWithDatabase
+
+
+class MatchRideTest(TestWithDatabase):
+
+    def setUp(self):
+        super().setUp()
+        self.url = url_for(f'{BLUEPRINT_API_NAME}.{match_ride.__name__}')
+        self.org = db.session.query(Organization).filter_by(id=1).first()
+        self.query = {
+            'organizationId': self.org.id,
+            'latitude': self.org.latitude,
+            'longitude': self.org.longitude,
+            'fromOrganization': True,
+            'maxDistance': 1000,
+        }
+
+    def _match(self, **params):
+        with login_as(self.client, self.org.users[0]):
+            return self.client.get(self.url, query_string={**self.query, **params})
+
+    def test_sorted_by_distance(self):
+        response = self._match()
+        self.assert200(response)
+        rides = [db.session.query(Ride).get(x['id']) for x in response.json]
+        self.assertTrue(rides)
+        self.assertTrue(all(ride.from_organization and ride.is_active for ride in rides))
+        distances = [
+            haversine_km(ride.latitude, ride.longitude, self.org.latitude, self.org.longitude)
+            for ride in rides
+        ]
+        self.assertEqual(sorted(distances), distances)
+
+    def test_max_distance(self):
+        response = self._match(maxDistance=0)
+        self.assert200(response)
+        self.assertEqual([], response.json)
+
+    def test_pagination(self):
+        expected = [x['id'] for x in self._match().json]
+        self.assertEqual(expected, self._match_pages())
+
+    def test_pagination_with_time_weight(self):
+        self.app.config['MATCH_TIME_WEIGHT'] = 1
+        expected = [x['id'] for x in self._match().json]
+        self.assertEqual(expected, self._match_pages())
+
+    @unittest.skipUnless(hasattr(time, 'tzset'), 'needs time.tzset')
+    def test_timezone_aware_start(self):
+        ride = db.session.query(Ride).filter_by(
+            organization_id=self.org.id, from_organization=True, is_active=True).first()
+        # The server is not in UTC, and the client sends another offset
+        try:
+            with mock.patch.dict(os.environ, {'TZ': 'Asia/Tokyo'}):
+                time.tzset()
+                start = ride.start_datetime.astimezone(timezone(timedelta(hours=-5)))
+                response = self._match(startDatetime=start.isoformat(), timeWindow=0)
+        finally:
+            time.tzset()
+        self.assert200(response)
+        self.assertIn(ride.id, [x['id'] for x in response.json])
+
+    def _match_pages(self):
+        ids, cursor = [], None
+        while True:
+            params = {'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            response = self._match(**params)
+            self.assert200(response)
+            self.assertLessEqual(len(response.json), 2)
+            ids.extend(x['id'] for x in response.json)
+            cursor = response.headers.get(NEXT_CURSOR_HEADER)
+            if not cursor:
+                break
+        return ids
+
+    def test_weights(self):
+        self.app.config.update(MATCH_DISTANCE_WEIGHT=0, MATCH_PRICE_WEIGHT=1)
+        response = self._match()
+        self.assert200(response)
+        prices = [x['price'] for x in response.json]
+        self.assertTrue(prices)
+        self.assertEqual(sorted(prices), prices)
+
+    def test_query_count_is_constant(self):
+        # Warm-up, the first request of the app loads a few things once
+        self._match()
+        statements = []
+        db.event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(1))
+        counts = []
+        for limit in (1, 100):
+            statements.clear()
+            response = self._match(limit=limit)
+            self.assert200(response)
+            counts.append(len(statements))
+        self.assertGreater(len(response.json), 1)
+        # Eager loads of collections that are empty for all rides of a page are skipped,
+        # so a bigger page may take at most one more query per relationship, never per ride
+        relationships = {path for paths in RideJsonSchema.__eager_load__.values() for path in paths}
+        self.assertLessEqual(counts[1], counts[0] + len(relationships))
+
+    def test_invalid_cursor(self):
+        self.assert400(self._match(cursor='definitely not a cursor'))
+        for values in ([1.5, 1], ['abc', 1, {'$dt': '2020-01-01T12:00:00'}], [1.5, 1, 'abc']):
+            with self.subTest(values):
+                self.assert400(self._match(cursor=encode_cursor(values)))
+
+
+class MatchRideWithIndexTest(MatchRideTest):
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['RIDE_INDEX_ENABLED'] = True
+        self.app.ride_index.clear()
+
+    def test_same_as_query(self):
+        from_index = [x['id'] for x in self._match().json]
+        self.app.config['RIDE_INDEX_ENABLED'] = False
+        self.assertEqual([x['id'] for x in self._match().json], from_index)
+
+    def test_nearest_same_as_within(self):
+        index, group = self.app.ride_index, (self.org.id, True)
+        point = self.org.latitude, self.org.longitude
+        everything = index.within(group, *point, radius_km=20000)
+        self.assertGreater(len(everything), 3)
+        for k in (1, 3, len(everything) + 1):
+            with self.subTest(k=k):
+                self.assertEqual(everything[:k], index.nearest(group, *point, k=k))
+        self.assertEqual(
+            everything[3:6], index.nearest(group, *point, k=3, after=(
+                everything[2][0], everything[2][1].id)))
+        max_distance = everything[2][0]
+        self.assertEqual(
+            everything[:3], index.nearest(group, *point, k=10, max_distance_km=max_distance))
+
+    def test_within_small_radius(self):
+        # All rides share one cell, so a small box is looked up cell by cell
+        index, group = RideGridIndex(cell_size=10., ttl=60), (self.org.id, True)
+        _, entry = index.within(group, self.org.latitude, self.org.longitude, 20000)[0]
+        point = entry.latitude, entry.longitude
+        everything = index.within(group, *point, radius_km=20000)
+        self.assertEqual(1, len(index._grids[group]))
+        for radius in (0.5, 20, 50):
+            with self.subTest(radius=radius):
+                self.assertEqual(
+                    [x for x in everything if x[0] <= radius], index.within(group, *point, radius))
+
+    def test_follows_commits(self):
+        ids = [x['id'] for x in self._match().json]
+        ride = db.session.query(Ride).get(ids[0])
+        ride.is_active = False
+        db.session.commit()
+        self.assertNotIn(ride.id, self.app.ride_index._locations)
+        self.assertEqual(ids[1:], [x['id'] for x in self._match().json])
+
+    def test_follows_bulk_updates(self):
+        free_seats = {x['id']: x['freeSeats'] for x in self._match().json}
+        ride = next(
+            ride for ride in db.session.query(Ride).filter(Ride.id.in_(free_seats))
+            if ride.free_seats > 0
+        )
+        self.assertTrue(ride.reserve_seats())
+        refresh_rides([ride.id])
+        db.session.commit()
+        group, cell = self.app.ride_index._locations[ride.id]
+        self.assertEqual(
+            free_seats[ride.id] - 1, self.app.ride_index._grids[group][cell][ride.id].free_seats)
+
+
+class RateRideTest(TestWithDatabase):
+
+    def setUp(self):
+        super().setUp()
+        self.url = url_for(f'{BLUEPRINT_API_NAME}.{rate_ride.__name__}')
+        self.ride = db.session.query(Ride).filter(Ride.stop_datetime.isnot(None)).first()
+        self.ride.is_active = False
+        db.session.commit()
+
+    def _rate(self, passenger, rate):
+        with login_as(self.client, passenger):
+            return self.client.put(self.url, json={'ride': {'id': self.ride.id}, 'rate': rate})
+
+    def test_rating_is_updated(self):
+        passengers = self.ride.passengers[:2]
+        for passenger, rate in zip(passengers, (4, 9)):
+            self.assert200(self._rate(passenger, rate))
+        ride = db.session.query(Ride).get(self.ride.id)
+        self.assertEqual((13, 2), (ride.rating_sum, ride.rating_count))
+        self.assertEqual(6.5, ride.rating)
+        self.assertEqual(
+            [ride.id], [x for x, in db.session.query(Ride.id).filter(Ride.rating > 6)])
+        self.assertEqual([], find_rating_mismatches())
+
+
+class ActiveRidesTest(TestWithDatabase):
+
+    def setUp(self):
+        super().setUp()
+        self.url = url_for(f'{BLUEPRINT_API_NAME}.{active_rides.__name__}')
+
+    def test_host_answer(self):
+        answers = {1: 'ACCEPTED', 0: 'NO ANSWER', -1: 'DECLINED'}
+        for status in answers:
+            join_request = db.session.query(JoinRideRequest).filter_by(status=status).first()
+            with login_as(self.client, join_request.user):
+                response = self.client.get(self.url)
+            self.assert200(response)
+            expected = {
+                x.ride_id: answers[x.status] for x in join_request.user.join_requests
+                if x.ride.is_active
+            }
+            self.assertEqual(expected, {x['id']: x['hostAnswer'] for x in response.json})
+
+    def test_host_answer_after_join(self):
+        ride = db.session.query(Ride).filter(Ride.is_active).first()
+        user = next(
+            user for user in ride.organization.users
+            if user != ride.host and user not in [x.user for x in ride.join_requests]
+        )
+        schema = RideJsonSchema(only=('id', 'host_answer'))
+        with self.app.test_request_context():
+            login_user(user)
+            self.assertIsNone(schema.dump(ride)['hostAnswer'])
+            db.session.add(JoinRideRequest(user=user, ride=ride))
+            db.session.flush()
+            self.assertEqual('NO ANSWER', schema.dump(ride)['hostAnswer'])
+
+    def test_missing_address_is_not_stored(self):
+        join_request = db.session.query(JoinRideRequest).join(JoinRideRequest.ride).\
+            filter(Ride.is_active).first()
+        ride = join_request.ride
+        ride.address = None
+        db.session.commit()
+        key = reverse_geocoding_key(
+            ride.latitude, ride.longitude, self.app.config['GEOCODING_CACHE_PRECISION'])
+        self.app.reverse_geocoding_cache.local.set(key, {'address': 'Resolved address'})
+        with login_as(self.client, join_request.user):
+            response = self.client.get(self.url)
+        self.assert200(response)
+        self.assertEqual(
+            'Resolved address', next(x['address'] for x in response.json if x['id'] == ride.id))
+        self.assertIsNone(ride.address)
+        self.assertNotIn(ride, db.session.dirty)
+
+    def test_invalid_cursor(self):
+        with login_as(self.client, db.session.query(JoinRideRequest).first().user):
+            for values in (['abc', 1], [{'x': 1}, 1], [{'$dt': '2020-01-01T12:00:00'}, 'abc']):
+                with self.subTest(values):
+                    response = self.client.get(
+                        self.url, query_string={'cursor': encode_cursor(values)})
+                    self.assert400(response)
+
+
+class AcceptRequestTest(TestWithDatabase):
+
+    def setUp(self):
+        super().setUp()
+        self.url = url_for(f'{BLUEPRINT_API_NAME}.{accept_request.__name__}')
+        org = db.session.query(Organization).filter_by(id=1).first()
+        self.host = next(user for user in org.users if user.cars)
+        self.ride = RideFactory(
+            organization=org, host=self.host, passengers=[], total_seats=2, from_organization=True
+        )
+        self.passengers = [user for user in org.users if user != self.host][:8]
+        for user in self.passengers:
+            db.session.add(JoinRideRequest(user=user, ride=self.ride))
+        db.session.commit()
+
+    def test_concurrent_accepts_do_not_overbook(self):
+        barrier = threading.Barrier(len(self.passengers))
+        statuses = []
+        # Load everything the threads need here, the objects belong to this thread's session
+        ride_id, user_ids, _ = self.ride.id, [user.id for user in self.passengers], self.host.email
+
+        def accept(user_id):
+            client = self.app.test_client()
+            with self.app.test_request_context(), login_as(client, self.host):
+                barrier.wait()
+                response = client.post(self.url, json={'userId': user_id, 'rideId': ride_id})
+            statuses.append(response.status_code)
+
+        threads = [
+            threading.Thread(target=accept, args=(user_id, )) for user_id in user_ids
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([200] * 2 + [NoFreeSeats.code] * 6, sorted(statuses))
+        db.session.expire_all()
+        ride = db.session.query(Ride).get(self.ride.id)
+        self.assertEqual(2, ride.occupied_seats)
+        self.assertEqual(2, len(ride.passengers))
+        self.assertEqual(0, ride.free_seats)
+
+
+class RidesHistoryTest(TestWithDatabase):
+
+    def setUp(self):
+        super().setUp()
+        self.url = url_for(f'{BLUEPRINT_API_NAME}.{my_rides_history.__name__}')
+        self.user = db.session.query(JoinRideRequest).filter_by(status=1).first().user
+        self.finished = [x.ride for x in self.user.join_requests]
+        for ride in self.finished:
+            ride.is_active = False
+        db.session.commit()
+
+    def test_pagination(self):
+        self.assertGreater(len(self.finished), 1)
+        expected = sorted(self.finished, key=lambda x: (x.start_datetime, x.id), reverse=True)
+        ids, cursor = [], None
+        with login_as(self.client, self.user):
+            while True:
+                response = self.client.get(
+                    self.url, query_string={'limit': 1, **({'cursor': cursor} if cursor else {})})
+                self.assert200(response)
+                self.assertLessEqual(len(response.json), 1)
+                ids.extend(x['id'] for x in response.json)
+                cursor = response.headers.get(NEXT_CURSOR_HEADER)
+                if not cursor:
+                    break
+        self.assertEqual([x.id for x in expected], ids)
+
+
+class FinishCancelRideTest(TestWithDatabase):
+
+    def setUp(self):
+        super().setUp()
+        # A ride with undecided, accepted and declined requests
+        self.ride = db.session.query(JoinRideRequest).filter_by(status=1).first().ride
+        org = self.ride.organization
+        others = [
+            user for user in org.users
+            if user != self.ride.host and user not in [x.user for x in self.ride.join_requests]
+        ]
+        db.session.add(JoinRideRequest(user=others[0], ride=self.ride, status=0))
+        db.session.add(JoinRideRequest(user=others[1], ride=self.ride, status=-1))
+        db.session.commit()
+        self.statuses = {x.user_id: x.status for x in self.ride.join_requests}
+
+    def _post(self, view):
+        with login_as(self.client, self.ride.host):
+            response = self.client.post(
+                url_for(f'{BLUEPRINT_API_NAME}.{view.__name__}'), json={'id': self.ride.id})
+        self.assert200(response)
+        db.session.expire_all()
+        return db.session.query(Ride).get(self.ride.id)
+
+    def test_finish(self):
+        passengers = len(self.ride.passengers)
+        ride = self._post(finish_ride)
+        self.assertFalse(ride.is_active)
+        self.assertEqual(passengers, len(ride.passengers))
+        self.assertEqual(
+            {user_id: -1 if status == 0 else status for user_id, status in self.statuses.items()},
+            {x.user_id: x.status for x in ride.join_requests})
+
+    def test_cancel(self):
+        ride = self._post(cancel_ride)
+        self.assertFalse(ride.is_active)
+        self.assertEqual([], ride.passengers)
+        self.assertEqual(0, ride.occupied_seats)
+        self.assertEqual({-1}, {x.status for x in ride.join_requests})
+        with login_as(self.client, self.ride.host):
+            response = self.client.post(
+                url_for(f'{BLUEPRINT_API_NAME}.{cancel_ride.__name__}'), json={'id': ride.id})
+        self.assertStatus(response, RideNotActive.code)
+
+
+class DecideRequestsTest(TestWithDatabase):
+
+    def setUp(self):
+        super().setUp()
+        self.ride = db.session.query(JoinRideRequest).filter_by(status=0).first().ride
+        self.user_ids = sorted(x.user_id for x in self.ride.join_requests if x.status == 0)
+        self.assertGreater(len(self.user_ids), 1)
+
+    def _post(self, view, json):
+        with login_as(self.client, self.ride.host):
+            return self.client.post(
+                url_for(f'{BLUEPRINT_API_NAME}.{view.__name__}'),
+                json={'rideId': self.ride.id, **json})
+
+    def test_accept_many(self):
+        response = self._post(accept_requests, {'userIds': self.user_ids + [-1]})
+        self.assert200(response)
+        self.assertEqual(self.user_ids, sorted(response.json['userIds']))
+        db.session.expire_all()
+        self.assertEqual(self.user_ids, sorted(x.id for x in self.ride.passengers))
+        self.assertEqual(len(self.user_ids), self.ride.occupied_seats)
+        # Already decided
+        response = self._post(accept_requests, {'userIds': self.user_ids})
+        self.assertEqual([], response.json['userIds'])
+
+    def test_accept_many_without_seats(self):
+        self.ride.total_seats = len(self.user_ids) - 1
+        db.session.commit()
+        response = self._post(accept_requests, {'userIds': self.user_ids})
+        self.assertStatus(response, NoFreeSeats.code)
+        db.session.expire_all()
+        self.assertEqual([], self.ride.passengers)
+        self.assertEqual({0}, {x.status for x in self.ride.join_requests})
+
+    def test_decline_many(self):
+        response = self._post(
+            decline_requests, {'userIds': self.user_ids, 'declineReason': 'no room'})
+        self.assert200(response)
+        self.assertEqual(self.user_ids, sorted(response.json['userIds']))
+        db.session.expire_all()
+        self.assertEqual(
+            {(-1, 'no room')}, {(x.status, x.decline_reason) for x in self.ride.join_requests})
+
+    def test_concurrent_decisions_on_one_request(self):
+        barrier = threading.Barrier(4)
+        statuses = []
+        ride_id, user_id, _ = self.ride.id, self.user_ids[0], self.ride.host.email
+
+        def decide(view):
+            client = self.app.test_client()
+            with self.app.test_request_context(), login_as(client, self.ride.host):
+                barrier.wait()
+                response = client.post(
+                    url_for(f'{BLUEPRINT_API_NAME}.{view.__name__}'),
+                    json={'userId': user_id, 'rideId': ride_id})
+            statuses.append(response.status_code)
+
+        threads = [
+            threading.Thread(target=decide, args=(view, ))
+            for view in [accept_request, decline_request] * 2
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([200] + [AlreadyDecided.code] * 3, sorted(statuses))
+
+    def test_concurrent_cancel_and_accept(self):
+        barrier = threading.Barrier(2)
+        statuses = {}
+        ride_id, user_id, _ = self.ride.id, self.user_ids[0], self.ride.host.email
+
+        def post(view, json):
+            client = self.app.test_client()
+            with self.app.test_request_context(), login_as(client, self.ride.host):
+                barrier.wait()
+                response = client.post(
+                    url_for(f'{BLUEPRINT_API_NAME}.{view.__name__}'), json=json)
+            statuses[view] = response.status_code
+
+        threads = [
+            threading.Thread(target=post, args=(cancel_ride, {'id': ride_id})),
+            threading.Thread(target=post, args=(
+                accept_request, {'userId': user_id, 'rideId': ride_id})),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(200, statuses[cancel_ride])
+        # Accepted before the cancel or too late
+        self.assertIn(statuses[accept_request], [200, AlreadyDecided.code])
+        db.session.expire_all()
+        ride = db.session.query(Ride).get(ride_id)
+        self.assertFalse(ride.is_active)
+        self.assertEqual([], ride.passengers)
+        self.assertEqual(0, ride.occupied_seats)
+        self.assertEqual({-1}, {x.status for x in ride.join_requests})
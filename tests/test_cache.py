@@ -0,0 +1,224 @@
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from flask_testing import TestCase
+
+from app import create_app, db
+from main_app.cache import GeocodingCache, LRUCache, SingleFlight, reverse_geocoding_key
+from main_app.model import GeocodingCacheEntry
+
+
+class Clock:
+    """
+    Stands in for `time.monotonic`
+    """
+
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('main_app.cache.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_ttl_expiry(self):
+        cache = LRUCache(maxsize=10, ttl=60)
+        cache.set('key', 'value')
+        self.clock.now += 59
+        self.assertEqual('value', cache.get('key'))
+        self.clock.now += 2
+        self.assertIsNone(cache.get('key'))
+        # Still there for a stale fallback
+        self.assertEqual('value', cache.get('key', allow_expired=True))
+
+    def test_custom_ttl(self):
+        cache = LRUCache(maxsize=10, ttl=60)
+        cache.set('key', 'value', ttl=5)
+        self.clock.now += 6
+        self.assertIsNone(cache.get('key'))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('b', allow_expired=True))
+        self.assertEqual((1, 3), (cache.get('a'), cache.get('c')))
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def _run_concurrently(self, flight, func, threads=8):
+        """
+        :return: `(result or exception, shared)` of every thread
+        """
+        outcomes = []
+
+        def call():
+            try:
+                outcomes.append(flight.do('key', func))
+            except Exception as e:
+                outcomes.append((e, True))
+
+        workers = [threading.Thread(target=call) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return outcomes
+
+    def _slow(self, func):
+        """
+        `func` that runs long enough for every thread to wait for it
+        """
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(.2)
+            return func()
+        return slow, calls
+
+    def test_concurrent_callers_share_one_call(self):
+        func, calls = self._slow(lambda: 'value')
+        outcomes = self._run_concurrently(SingleFlight(), func)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(['value'] * 8, [result for result, _ in outcomes])
+        self.assertEqual(7, sum(shared for _, shared in outcomes))
+
+    def test_error_is_shared(self):
+        error = ValueError('geocoder is down')
+
+        def fail():
+            raise error
+
+        func, calls = self._slow(fail)
+        outcomes = self._run_concurrently(SingleFlight(), func)
+        self.assertEqual(1, len(calls))
+        self.assertEqual([error] * 8, [result for result, _ in outcomes])
+
+    def test_finished_call_is_not_reused(self):
+        flight = SingleFlight()
+        self.assertEqual((1, False), flight.do('key', lambda: 1))
+        self.assertEqual((2, False), flight.do('key', lambda: 2))
+
+
+class ReverseGeocodingKeyTest(unittest.TestCase):
+
+    def test_nearby_points_share_key(self):
+        self.assertEqual(
+            reverse_geocoding_key(55.75581, 37.61731, 4),
+            reverse_geocoding_key(55.75579, 37.6173, 4))
+        self.assertNotEqual(
+            reverse_geocoding_key(55.7558, 37.6173, 4), reverse_geocoding_key(55.7568, 37.6173, 4))
+
+
+class GeocodingCacheTest(TestCase):
+
+    def create_app(self):
+        return create_app()
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+    def test_persistent_tier_is_shared(self):
+        GeocodingCache('test', maxsize=10, ttl=60).set('key', {'address': 'Moscow'})
+        # Another worker
+        cache = GeocodingCache('test', maxsize=10, ttl=60)
+        self.assertEqual({'address': 'Moscow'}, cache.get('key'))
+        self.assertEqual({'address': 'Moscow'}, cache.get('key'))
+        stats = cache.stats()
+        self.assertEqual((1, 1), (stats['persistent_hits'], stats['local_hits']))
+
+    def test_persistent_tier_expiry(self):
+        GeocodingCache('test', maxsize=10, ttl=60).set('key', {'address': 'Moscow'})
+        db.session.query(GeocodingCacheEntry).update(
+            {GeocodingCacheEntry.updated_at: datetime.utcnow() - timedelta(seconds=61)})
+        db.session.commit()
+        cache = GeocodingCache('test', maxsize=10, ttl=60)
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual({'address': 'Moscow'}, cache.get_stale('key'))
+
+    def test_get_many_reads_table_once(self):
+        writer = GeocodingCache('test', maxsize=10, ttl=60)
+        for key in ('a', 'b', 'c'):
+            writer.set(key, {'address': key})
+        cache = GeocodingCache('test', maxsize=10, ttl=60)
+        cache.local.set('a', {'address': 'local'})
+        statements = []
+
+        def listener(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        db.event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            found = cache.get_many(['a', 'b', 'c', 'missing', 'b'])
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(
+            {'a': {'address': 'local'}, 'b': {'address': 'b'}, 'c': {'address': 'c'}}, found)
+        self.assertEqual(1, len(statements))
+        self.assertEqual(
+            (1, 2, 1), tuple(cache.stats()[x] for x in ('local_hits', 'persistent_hits', 'misses')))
+        # Now in the first tier
+        self.assertEqual({'address': 'b'}, cache.local.get('b'))
+
+    def test_namespaces_are_separate(self):
+        GeocodingCache('test', maxsize=10, ttl=60).set('key', {'address': 'Moscow'})
+        self.assertIsNone(GeocodingCache('other', maxsize=10, ttl=60).get('key'))
+
+    def test_not_persistent(self):
+        GeocodingCache('test', maxsize=10, ttl=60, persistent=False).set('key', 'value')
+        self.assertEqual(0, db.session.query(GeocodingCacheEntry).count())
+
+    def test_lease_holder_answer_is_shared_across_workers(self):
+        holder = GeocodingCache('test', maxsize=10, ttl=60, lease_poll_interval=.01)
+        self.assertTrue(holder._acquire_lease('key'))
+        waiter = GeocodingCache('test', maxsize=10, ttl=60, lease_poll_interval=.01)
+        fetch = mock.Mock(return_value={'address': 'elsewhere'})
+        results = []
+
+        def wait():
+            with self.app.app_context():
+                results.append(waiter.fetch('key', fetch))
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        # The waiter polls the row meanwhile
+        time.sleep(.1)
+        holder.set('key', {'address': 'Moscow'})
+        thread.join()
+        self.assertEqual([{'address': 'Moscow'}], results)
+        fetch.assert_not_called()
+        self.assertEqual(1, waiter.stats()['coalesced_across_workers'])
+
+    def test_lease_timeout(self):
+        holder = GeocodingCache('test', maxsize=10, ttl=60)
+        self.assertTrue(holder._acquire_lease('key'))
+        # The holder never answers
+        waiter = GeocodingCache('test', maxsize=10, ttl=60, lease_timeout=.1,
+                                lease_poll_interval=.01)
+        fetch = mock.Mock(return_value={'address': 'Moscow'})
+        self.assertEqual({'address': 'Moscow'}, waiter.fetch('key', fetch))
+        fetch.assert_called_once_with()
+
+    def test_expired_lease_is_taken_over(self):
+        holder = GeocodingCache('test', maxsize=10, ttl=60, lease_timeout=.05)
+        self.assertTrue(holder._acquire_lease('key'))
+        other = GeocodingCache('test', maxsize=10, ttl=60)
+        self.assertFalse(other._acquire_lease('key'))
+        time.sleep(.1)
+        self.assertTrue(other._acquire_lease('key'))
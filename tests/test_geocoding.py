@@ -0,0 +1,58 @@
+from unittest import mock
+
+from flask_testing import TestCase
+
+from app import create_app, db
+from main_app.misc import FORWARD_GEOCODING_RESULTS, forward_geocoding_blocking
+from main_app.model import GeocodingCacheEntry
+
+
+def _result(address):
+    return {'address': address, 'gps': {'latitude': '55.75', 'longitude': '37.61'}}
+
+
+class ForwardGeocodingTest(TestCase):
+
+    def create_app(self):
+        return create_app()
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.cache = self.app.forward_geocoding_cache
+        self.cache.local._data.clear()
+        patcher = mock.patch('main_app.misc._forward_geocoding_request')
+        self.request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_complete_prefix_answer_is_reused(self):
+        self.cache.local.set('tver', [_result('Moscow, Tverskaya 1'), _result('Tver')])
+        self.assertEqual([_result('Moscow, Tverskaya 1')], forward_geocoding_blocking('Tverskaya'))
+        self.request.assert_not_called()
+
+    def test_full_prefix_answer_is_not_reused(self):
+        self.cache.local.set('tver', [
+            _result(f'Moscow, Tverskaya {i}') for i in range(FORWARD_GEOCODING_RESULTS)
+        ])
+        self.request.return_value = [_result('Moscow, Tverskaya 20')]
+        self.assertEqual([_result('Moscow, Tverskaya 20')], forward_geocoding_blocking('Tverskaya'))
+        self.request.assert_called_once_with('tverskaya')
+
+    def test_prefix_without_matches_is_not_reused(self):
+        self.cache.local.set('tver', [_result('Tver')])
+        self.request.return_value = [_result('Moscow, Tverskaya 1')]
+        self.assertEqual([_result('Moscow, Tverskaya 1')], forward_geocoding_blocking('Tverskaya'))
+        self.request.assert_called_once_with('tverskaya')
+
+    def test_empty_answer_is_cached_in_process_only(self):
+        self.request.return_value = []
+        clock = [1000.]
+        with mock.patch('main_app.cache.time.monotonic', lambda: clock[0]):
+            self.assertEqual([], forward_geocoding_blocking('Nowhere street'))
+            self.assertEqual([], forward_geocoding_blocking('  nowhere  Street'))
+            self.assertEqual(1, self.request.call_count)
+            self.assertEqual(0, db.session.query(GeocodingCacheEntry).
+                             filter(GeocodingCacheEntry.value.isnot(None)).count())
+            clock[0] += self.app.config['GEOCODING_NEGATIVE_CACHE_TTL'] + 1
+            forward_geocoding_blocking('Nowhere street')
+        self.assertEqual(2, self.request.call_count)
@@ -0,0 +1,117 @@
+import unittest
+from unittest import mock
+
+from main_app.exceptions.custom import DependencyUnavailable
+from main_app.outbound import CircuitBreaker, DependencyGuard, TokenBucket
+
+
+class ClockTestCase(unittest.TestCase):
+    """
+    `time.monotonic` of `main_app.outbound` is `self.now`
+    """
+
+    def setUp(self):
+        self.now = 1000.
+        patcher = mock.patch('main_app.outbound.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TokenBucketTest(ClockTestCase):
+
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(rate=2, capacity=3)
+        self.assertEqual([True] * 3 + [False], [bucket.try_acquire() for _ in range(4)])
+        self.now += .5
+        self.assertEqual([True, False], [bucket.try_acquire() for _ in range(2)])
+        # Refill stops at the capacity
+        self.now += 60
+        self.assertEqual([True] * 3 + [False], [bucket.try_acquire() for _ in range(4)])
+
+    def test_disabled(self):
+        bucket = TokenBucket(rate=0, capacity=1)
+        self.assertTrue(all(bucket.try_acquire() for _ in range(100)))
+
+
+class CircuitBreakerTest(ClockTestCase):
+
+    def _open(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
+        for _ in range(3):
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        return breaker
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+
+    def test_open_rejects_calls(self):
+        breaker = self._open()
+        self.assertFalse(breaker.allow())
+        self.now += 9
+        self.assertFalse(breaker.allow())
+
+    def test_half_open_lets_one_trial_through(self):
+        breaker = self._open()
+        self.now += 10
+        self.assertEqual(CircuitBreaker.HALF_OPEN, breaker.state)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+    def test_trial_success_closes(self):
+        breaker = self._open()
+        self.now += 10
+        breaker.allow()
+        breaker.record_success()
+        self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+        self.assertTrue(breaker.allow())
+
+    def test_trial_failure_opens_again(self):
+        breaker = self._open()
+        self.now += 10
+        breaker.allow()
+        breaker.record_failure()
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        self.assertFalse(breaker.allow())
+
+    def test_disabled(self):
+        breaker = CircuitBreaker(failure_threshold=0, reset_timeout=10)
+        for _ in range(10):
+            breaker.record_failure()
+        self.assertTrue(breaker.allow())
+
+
+class DependencyGuardTest(ClockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.guard = DependencyGuard(
+            'yandex', TokenBucket(rate=1, capacity=2),
+            CircuitBreaker(failure_threshold=1, reset_timeout=10))
+
+    def test_rate_limit(self):
+        self.guard.call(lambda: None)
+        self.guard.call(lambda: None)
+        with self.assertRaises(DependencyUnavailable):
+            self.guard.call(lambda: None)
+        self.assertEqual(1, self.guard.stats()['rejected'])
+
+    def test_failed_result_opens_breaker(self):
+        self.guard.call(lambda: 503, is_failure=lambda status: status >= 500)
+        self.assertEqual(CircuitBreaker.OPEN, self.guard.stats()['state'])
+        with self.assertRaises(DependencyUnavailable):
+            self.guard.call(lambda: 200)
+
+    def test_only_failure_exceptions_count(self):
+        def fail():
+            raise KeyError('bad answer')
+
+        with self.assertRaises(KeyError):
+            self.guard.call(fail, failure_exceptions=(DependencyUnavailable, ))
+        self.assertEqual(CircuitBreaker.CLOSED, self.guard.stats()['state'])